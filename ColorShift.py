@@ -1,6 +1,22 @@
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw
+from PIL import Image, ImageEnhance, ImageFilter
+import argparse
+import glob
 import re
 import os
+import sys
+
+# The array engine modules live next to the Kivy version of the class
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ColorShift_Kivy"))
+import background
+import filters
+import gradients
+import instrumentation
+import kernels
+import presets
+import batch
+import encoders
+import manifest
+import masks
 
 class ColorShift:
     # Class constructor
@@ -16,10 +32,10 @@ class ColorShift:
         while True:
             path = input("Enter the image path: ").strip().replace("\\", "/")
             path = path.strip('"').strip("'")  
-            if re.match(r"^[a-zA-Z]:/.*\.(jpg|jpeg|png|bmp)$", path):
+            if re.match(r"^.+\.(jpg|jpeg|png|bmp)$", path, re.IGNORECASE):
                 return path
             else:
-                print("Invalid image path. Please enter a valid path (e.g., C:/path/to/image.jpg).")
+                print("Invalid image path. Please enter a valid path (e.g., C:/path/to/image.jpg or /path/to/image.jpg).")
 
     # Get and validate user choice input
     def get_user_option(self):
@@ -71,7 +87,8 @@ class ColorShift:
     # Load and convert the image
     def load_image(self, image_path):
         try:
-            img = Image.open(image_path).convert("RGB")
+            with instrumentation.timed_io("load", image_path):
+                img = Image.open(image_path).convert("RGB")
             print("Image loaded successfully.")
             return img
         except (FileNotFoundError, IOError):
@@ -79,53 +96,52 @@ class ColorShift:
             return None
 
     # Convert the image to black and white
+    @instrumentation.instrumented
     def convert_to_black_and_white(self):
         self.img = self.img.convert("L").convert("RGB")  # Convert to grayscale and back to RGB
 
     # Change the background color of the image
+    @instrumentation.instrumented
     def change_black_background(self, new_bg_color):
-        data = self.img.getdata()
-        new_image_data = []
-        for item in data:
-            if all(val < 30 for val in item):
-                new_image_data.append(new_bg_color)
-            else:
-                new_image_data.append(item)
-        self.img.putdata(new_image_data)
+        rgb, alpha = kernels.to_array(self.img)
+        kernels.change_black_background(rgb, new_bg_color)
+        self.img = kernels.from_array(rgb, alpha)
         print("Background color changed successfully.")
         return self.img
 
+    # Change only the near-black background connected to the image border, leaving dark areas
+    # inside the subject alone (feather > 0 softens the edge over that many pixels)
+    @instrumentation.instrumented
+    def replace_border_background(self, new_bg_color, threshold=background.DEFAULT_THRESHOLD, feather=background.DEFAULT_FEATHER):
+        rgb, alpha = kernels.to_array(self.img)
+        background.replace_border_background(rgb, new_bg_color, threshold, feather)
+        self.img = kernels.from_array(rgb, alpha)
+        print("Border background color changed successfully.")
+        return self.img
+
     # Change a specific color within the image
+    @instrumentation.instrumented
     def change_color(self, target_color, color_to_change):
         try:
-            data = self.img.getdata()
-            new_image_data = []
-            for item in data:
-                r, g, b = item
-                color_map = {'r': r, 'g': g, 'b': b}
-                if color_map[color_to_change] >= color_map['r'] and color_map[color_to_change] >= color_map['g'] and color_map[color_to_change] >= color_map['b']:
-                    factor = color_map[color_to_change] / 255.0
-                    new_r = int((1 - factor) * r + factor * target_color[0])
-                    new_g = int((1 - factor) * g + factor * target_color[1])
-                    new_b = int((1 - factor) * b + factor * target_color[2])
-                    new_image_data.append((new_r, new_g, new_b))
-                else:
-                    new_image_data.append(item)
-            self.img.putdata(new_image_data)
+            rgb, alpha = kernels.to_array(self.img)
+            kernels.change_color(rgb, target_color, color_to_change)
+            self.img = kernels.from_array(rgb, alpha)
             print("Color changed successfully.")
         except Exception as e:
             print(f"Error occurred while processing the image: {e}")
 
     # Apply color mask
-    def apply_color_mask(self):
-        mask_color = self.get_target_color("Enter the color for the mask in RGB format: ")
-        data = self.img.getdata()
-        new_image_data = [(mask_color if (r < 100 and g < 100 and b < 100) else (r, g, b)) for (r, g, b) in data]
-        self.img.putdata(new_image_data)
+    @instrumentation.instrumented
+    def apply_color_mask(self, mask_color):
+        rgb, alpha = kernels.to_array(self.img)
+        kernels.apply_color_mask(rgb, mask_color)
+        self.img = kernels.from_array(rgb, alpha)
         print("Color mask applied successfully.")
 
-    # Batch process images for black and white transformation
-    def batch_process_images(self):
+    # Batch process images (black and white by default) on all cores.
+    # Incremental runs skip images that were processed before and have not changed, tracked in a
+    # manifest file kept in the folder (see manifest.py); the skipped images are listed.
+    def batch_process_images(self, steps=(("convert_to_black_and_white",),), workers=None, incremental=False):
         while True:
             folder_path = input("Enter the folder path containing images for batch processing: ").strip().replace("\\", "/")
             folder_path = folder_path.strip('"').strip("'")
@@ -137,20 +153,19 @@ class ColorShift:
                 print("Error: The provided path is not a directory. Please enter a valid folder path.")
                 continue
             try:
-                image_files = [f"{folder_path}/{f}" for f in os.listdir(folder_path) if re.match(r".*\.(jpg|jpeg|png|bmp)$", f)]
-                for image_path in image_files:
-                    try:
-                        img = Image.open(image_path).convert("RGB")
-                        img = img.convert("L").convert("RGB")
-                        img.save(image_path.replace(".", "-Processed."))
-                        print(f"Processed {image_path}.")
-                    except Exception as e:
-                        print(f"Skipping {image_path} due to error: {e}")
+                image_files = batch.list_images(folder_path)
+                run_manifest = manifest.Manifest(os.path.join(folder_path, manifest.MANIFEST_NAME)) if incremental else None
+                results = batch.batch_process(image_files, steps, workers=workers, manifest=run_manifest)
+                processed = {path for path, _ in results}
+                skipped = [path for path in image_files if path not in processed]
+                if skipped:
+                    print(f"Unchanged since the last run: {', '.join(os.path.basename(path) for path in skipped)}")
                 break
             except FileNotFoundError:
                 print("Invalid folder path. Please try again.")
 
     # Adjust contrast and brightness
+    @instrumentation.instrumented
     def adjust_contrast_brightness(self, contrast_factor, brightness_factor):
         enhancer_contrast = ImageEnhance.Contrast(self.img)
         self.img = enhancer_contrast.enhance(contrast_factor)
@@ -158,57 +173,23 @@ class ColorShift:
         self.img = enhancer_brightness.enhance(brightness_factor)
 
     # Apply color preset
+    @instrumentation.instrumented
     def apply_color_preset(self, preset):
-        valid_presets = ["warm", "cool", "vintage", "sepia"]
-        while preset not in valid_presets:
-            preset = input(f"Invalid preset. Choose one from {valid_presets}: ")
-        
-        # Apply Sepia preset
-        if preset == 'sepia':
-            sepia_filter = [(int(r * 0.393 + g * 0.769 + b * 0.189),
-                            int(r * 0.349 + g * 0.686 + b * 0.168),
-                            int(r * 0.272 + g * 0.534 + b * 0.131))
-                            for (r, g, b) in self.img.getdata()]
-            self.img.putdata(sepia_filter)
-            print("Sepia preset applied.")
-        
-        # Apply Cool preset
-        elif preset == 'cool':
-            cool_filter = [(int(r * 0.8), int(g * 0.9), int(b * 1.1)) for (r, g, b) in self.img.getdata()]
-            self.img.putdata(cool_filter)
-            print("Cool preset applied.")
-        
-        # Apply Warm preset
-        elif preset == 'warm':
-            warm_filter = [(int(r * 1.1), int(g * 0.9), int(b * 0.8)) for (r, g, b) in self.img.getdata()]
-            self.img.putdata(warm_filter)
-            print("Warm preset applied.")
-        
-        # Apply Vintage preset
-        elif preset == 'vintage':
-            vintage_filter = [(int(r * 0.9 + g * 0.7 + b * 0.4),
-                            int(r * 0.6 + g * 0.5 + b * 0.3),
-                            int(r * 0.3 + g * 0.2 + b * 0.1))
-                            for (r, g, b) in self.img.getdata()]
-            self.img.putdata(vintage_filter)
-            print("Vintage preset applied.")
+        rgb, alpha = kernels.to_array(self.img)
+        kernels.apply_color_preset(rgb, preset)
+        self.img = kernels.from_array(rgb, alpha)
+        print(f"{preset.capitalize()} preset applied.")
         
         print(f"Applied {preset} preset.")
 
-    # Apply gradient
-    def apply_gradient(self, color1, color2):
-        width, height = self.img.size
-        gradient = Image.new('RGB', (width, height))
-        draw = ImageDraw.Draw(gradient)
-        for i in range(height):
-            r = int(color1[0] + (color2[0] - color1[0]) * i / height)
-            g = int(color1[1] + (color2[1] - color1[1]) * i / height)
-            b = int(color1[2] + (color2[2] - color1[2]) * i / height)
-            draw.line([(0, i), (width, i)], fill=(r, g, b))
-        self.img = Image.blend(self.img, gradient, alpha=0.5)
+    # Apply gradient (shape: vertical, horizontal, diagonal or radial; alpha is the gradient's weight)
+    @instrumentation.instrumented
+    def apply_gradient(self, color1, color2, shape="vertical", alpha=gradients.DEFAULT_ALPHA):
+        self.img = gradients.blend_gradient_image(self.img, color1, color2, shape, alpha)
         print("Gradient applied.")
 
     # Apply sharpen or blur
+    @instrumentation.instrumented
     def apply_sharpen_blur(self, effect):
         if effect == "sharpen":
             self.img = self.img.filter(ImageFilter.SHARPEN)
@@ -216,10 +197,35 @@ class ColorShift:
             self.img = self.img.filter(ImageFilter.BLUR)
         print(f"Applied {effect} effect.")
 
+    # Gaussian blur with a radius in pixels (the standard deviation); costs the same at any radius
+    @instrumentation.instrumented
+    def apply_gaussian_blur(self, radius):
+        self.apply_filter("apply_gaussian_blur", radius)
+        print(f"Applied a Gaussian blur of radius {radius}.")
+
+    # Box blur: the mean of the (2 * radius + 1)-pixel square around each pixel
+    @instrumentation.instrumented
+    def apply_box_blur(self, radius):
+        self.apply_filter("apply_box_blur", radius)
+        print(f"Applied a box blur of radius {radius}.")
+
+    # Unsharp mask: add back percent of the difference to a Gaussian blur of the radius, where it exceeds the threshold
+    @instrumentation.instrumented
+    def apply_unsharp_mask(self, radius, percent=filters.DEFAULT_PERCENT, threshold=filters.DEFAULT_THRESHOLD):
+        self.apply_filter("apply_unsharp_mask", radius, percent, threshold)
+        print(f"Applied an unsharp mask of radius {radius}.")
+
+    # Run a variable-radius filter in row tiles (see filters.py)
+    def apply_filter(self, name, *params):
+        params = filters.normalize(name, params)
+        if filters.is_identity(name, params):
+            return
+        rgb, alpha = kernels.to_array(self.img)
+        self.img = kernels.from_array(filters.apply(rgb, name, params), alpha)
+
     # Apply transparency
+    @instrumentation.instrumented
     def apply_transparency(self, transparency_level):
-        while not (0 <= transparency_level <= 255):
-            transparency_level = int(input("Enter a valid transparency level (0 to 255): "))
         self.img.putalpha(transparency_level)
         print("Transparency applied successfully.")
 
@@ -229,15 +235,19 @@ class ColorShift:
             return self.convert_to_black_and_white()
         elif self.user_option == 2:
             new_bg_color = self.get_target_color("Enter new background color in RGB format: ")
+            if input("Only replace the background connected to the image border? (y/N): ").lower().strip() in ("y", "yes"):
+                return self.replace_border_background(new_bg_color)
             return self.change_black_background(new_bg_color)
         elif self.user_option == 3:
             target_color = self.get_target_color("Enter the color to change: ")
             color_to_change = self.get_color_to_change()
             return self.change_color(target_color, color_to_change)
         elif self.user_option == 4:
-            return self.apply_color_mask()
+            mask_color = self.get_target_color("Enter the color for the mask in RGB format: ")
+            return self.apply_color_mask(mask_color)
         elif self.user_option == 5:
-            return self.batch_process_images()
+            prompt = f"Skip images processed before and unchanged since? This keeps a {manifest.MANIFEST_NAME} file in the folder (y/N): "
+            return self.batch_process_images(incremental=input(prompt).lower().strip() in ("y", "yes"))
         elif self.user_option == 6:
             while True:
                 contrast_factor = float(input("Enter contrast factor (0.0 - 2.0): "))
@@ -252,19 +262,45 @@ class ColorShift:
                 else:
                     print("brightness factor value must be between 0 and 2")
         elif self.user_option == 7:
-            preset = input("Choose a color preset (warm, cool, vintage, sepia): ")
+            valid_presets = presets.preset_names()
+            preset = input(f"Choose a color preset ({', '.join(valid_presets)}): ")
+            while preset not in valid_presets:
+                preset = input(f"Invalid preset. Choose one from {valid_presets}: ")
             return self.apply_color_preset(preset)
         elif self.user_option == 8:
             color1 = self.get_target_color("Provide a color in RGB format: ")
             color2 = self.get_target_color("Provide a color in RGB format: ")
-            return self.apply_gradient(color1, color2)
+            while True:
+                shape = input(f"Choose gradient shape {list(gradients.GRADIENT_SHAPES)} (default vertical): ").lower().strip() or "vertical"
+                if shape in gradients.GRADIENT_SHAPES:
+                    break
+                print(f"Choose a valid option: {list(gradients.GRADIENT_SHAPES)}")
+            while True:
+                alpha = input(f"Enter gradient strength (0.0 - 1.0, default {gradients.DEFAULT_ALPHA}): ").strip()
+                try:
+                    alpha = float(alpha) if alpha else gradients.DEFAULT_ALPHA
+                except ValueError:
+                    alpha = -1
+                if 0 <= alpha <= 1:
+                    return self.apply_gradient(color1, color2, shape, alpha)
+                print("gradient strength must be between 0 and 1")
         elif self.user_option == 9:
+            radius_effects = {"gaussian": self.apply_gaussian_blur, "box": self.apply_box_blur, "unsharp": self.apply_unsharp_mask}
             while True:
-                effect = input("Choose effect (sharpen/blur): ").lower().strip()
+                effect = input("Choose effect (sharpen/blur/gaussian/box/unsharp): ").lower().strip()
                 if effect in ["sharpen", "blur"]:
                     return self.apply_sharpen_blur(effect)
+                elif effect in radius_effects:
+                    while True:
+                        try:
+                            radius = float(input("Enter the radius in pixels (e.g. 2 or 25): "))
+                        except ValueError:
+                            radius = -1
+                        if radius >= 0:
+                            return radius_effects[effect](radius)
+                        print("radius must be 0 or more")
                 else:
-                    print("Choose a valid option: ['sharpen', 'blur']")
+                    print("Choose a valid option: ['sharpen', 'blur', 'gaussian', 'box', 'unsharp']")
         elif self.user_option == 10:
             while True:
                 transparency_level = input("Enter transparency level (0 to 255): ")
@@ -278,13 +314,312 @@ class ColorShift:
     def save_image(self):
         try:
             output_path = self.image_path.replace(".jpg", "-Modified.jpg").replace(".jpeg", "-Modified.jpeg").replace(".png", "-Modified.png").replace(".bmp", "-Modified.bmp")
-            self.img.save(output_path)
+            encoders.save_image(self.img, output_path)
             print(f"Image saved successfully at {output_path}")
         except Exception as e:
             print(f"An error occurred while saving the image: {e}")
 
+
+# Headless mode: every effect of the menu (option 5, batch processing, is the mode itself)
+# as "--effect NAME ARG...", run over many files without a single prompt
+
+# Parse "R,G,B" or "(R, G, B)" into a color tuple
+def parse_color(text):
+    match = re.match(r"^\(?\s*(\d{1,3})\s*,\s*(\d{1,3})\s*,\s*(\d{1,3})\s*\)?$", text.strip())
+    if not match or not all(0 <= int(v) <= 255 for v in match.groups()):
+        raise ValueError(f"invalid RGB color '{text}' (expected e.g. 102,147,163)")
+    return tuple(int(v) for v in match.groups())
+
+
+def parse_factor(text):
+    value = float(text)
+    if not 0 <= value <= 2:
+        raise ValueError(f"factor must be between 0 and 2, got {text}")
+    return value
+
+
+def parse_choice(choices):
+    def parse(text):
+        if text.lower() not in choices:
+            raise ValueError(f"invalid choice '{text}' (choose from {', '.join(choices)})")
+        return text.lower()
+    return parse
+
+
+def parse_level(text):
+    value = int(text)
+    if not 0 <= value <= 255:
+        raise ValueError(f"transparency level must be between 0 and 255, got {text}")
+    return value
+
+
+def parse_alpha(text):
+    value = float(text)
+    if not 0 <= value <= 1:
+        raise ValueError(f"gradient strength must be between 0 and 1, got {text}")
+    return value
+
+
+def parse_threshold(text):
+    value = int(text)
+    if not 0 <= value <= 255:
+        raise ValueError(f"threshold must be between 0 and 255, got {text}")
+    return value
+
+
+def parse_feather(text):
+    value = int(text)
+    if value < 0:
+        raise ValueError(f"feather must be 0 or more pixels, got {text}")
+    return value
+
+
+def parse_radius(text):
+    value = float(text)
+    if value < 0:
+        raise ValueError(f"radius must be 0 or more, got {text}")
+    return value
+
+
+def parse_percent(text):
+    value = int(text)
+    if value < 0:
+        raise ValueError(f"percent must be 0 or more, got {text}")
+    return value
+
+
+# A mask criterion such as dark:100 (see masks.py), or the path of an exported mask image
+def parse_mask_source(text):
+    if os.path.isfile(text):
+        return text
+    return masks.parse_criterion(text)
+
+
+# CLI effect name -> (ColorShift method, required argument parsers, optional argument parsers, usage)
+EFFECTS = {
+    "black-and-white": ("convert_to_black_and_white", [], [], ""),
+    "background": ("change_black_background", [parse_color], [], "COLOR"),
+    "border-background": ("replace_border_background", [parse_color], [parse_threshold, parse_feather], "COLOR [THRESHOLD] [FEATHER]"),
+    "change-color": ("change_color", [parse_color, parse_choice(("r", "g", "b"))], [], "COLOR r|g|b"),
+    "color-mask": ("apply_color_mask", [parse_color], [], "COLOR"),
+    "mask": ("apply_mask", [parse_color, parse_mask_source], [], "COLOR CRITERION|MASKFILE"),
+    "contrast-brightness": ("adjust_contrast_brightness", [parse_factor, parse_factor], [], "CONTRAST BRIGHTNESS"),
+    "preset": ("apply_color_preset", [lambda text: parse_choice(presets.preset_names())(text)], [], "PRESET"),
+    "gradient": ("apply_gradient", [parse_color, parse_color], [parse_choice(gradients.GRADIENT_SHAPES), parse_alpha], "COLOR1 COLOR2 [SHAPE] [STRENGTH]"),
+    "sharpen-blur": ("apply_sharpen_blur", [parse_choice(("sharpen", "blur"))], [], "sharpen|blur"),
+    "gaussian-blur": ("apply_gaussian_blur", [parse_radius], [], "RADIUS"),
+    "box-blur": ("apply_box_blur", [parse_radius], [], "RADIUS"),
+    "unsharp-mask": ("apply_unsharp_mask", [parse_radius], [parse_percent, parse_threshold], "RADIUS [PERCENT] [THRESHOLD]"),
+    "transparency": ("apply_transparency", [parse_level], [], "LEVEL"),
+}
+
+OUTPUT_FORMATS = ("png", "jpg", "jpeg", "bmp", "tiff", "webp", "ppm")
+
+
+# Turn one "--effect NAME ARG..." into a pipeline step
+def parse_effect(values):
+    name, args = values[0].lower(), values[1:]
+    if name not in EFFECTS:
+        raise ValueError(f"unknown effect '{name}' (choose from {', '.join(EFFECTS)})")
+    method, required, optional, usage = EFFECTS[name]
+    if not len(required) <= len(args) <= len(required) + len(optional):
+        raise ValueError(f"usage: --effect {name} {usage}".rstrip())
+    return (method,) + tuple(parse(arg) for parse, arg in zip(required + optional, args))
+
+
+def build_parser():
+    effects_help = "; ".join(f"{name} {usage}".rstrip() for name, (_, _, _, usage) in EFFECTS.items())
+    parser = argparse.ArgumentParser(
+        description="Apply ColorShift effects to many images without any prompt. Run without arguments for the interactive menu.",
+        epilog="Colors are written R,G,B (e.g. 102,147,163). List the inputs before the first --effect.")
+    parser.add_argument("inputs", nargs="+", help="image files, glob patterns (quote them, ** matches subfolders), folders, or - to read one path per line from stdin")
+    parser.add_argument("-e", "--effect", dest="effects", action="append", nargs="+", default=[], metavar="ARG",
+                        help=f"effect to apply; repeat to chain effects in order. Effects: {effects_help}")
+    parser.add_argument("--export-mask", type=masks.parse_criterion, metavar="CRITERION",
+                        help=f"write the mask of CRITERION (dark:T, luminance:T, hsv:H1-H2:S:V or border:T) of each input as a 1-bit PNG named *{masks.MASK_SUFFIX}.png, for '--effect mask' on other images")
+    parser.add_argument("-r", "--recursive", action="store_true", help="also process images in the subfolders of folder inputs")
+    parser.add_argument("-o", "--output-dir", help="write results here (folder structure below folder inputs is kept) instead of next to each input")
+    parser.add_argument("-f", "--format", choices=OUTPUT_FORMATS, help="output format (default: same as the input)")
+    parser.add_argument("-p", "--profile", choices=encoders.profile_names(), default=encoders.DEFAULT_PROFILE,
+                        help="output encoder profile: preview-fast (fastest encode), archive (smallest lossless), web (progressive JPEG / lossy WebP); default: Pillow's defaults")
+    parser.add_argument("--suffix", help="appended to output file names (default: '-Processed', or nothing with --output-dir)")
+    parser.add_argument("-j", "--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--staged", action="store_true",
+                        help="run in one process with overlapped reader, compute (--workers) and writer threads; best on network storage")
+    parser.add_argument("--readers", type=int, default=batch.STAGED_READERS, help=f"decode threads of a --staged run (default {batch.STAGED_READERS})")
+    parser.add_argument("--writers", type=int, default=batch.STAGED_WRITERS, help=f"encode threads of a --staged run (default {batch.STAGED_WRITERS})")
+    parser.add_argument("--integer-kernels", action="store_true",
+                        help="use fixed-point integer math for blends, presets and color changes, so output is byte-identical on every machine")
+    parser.add_argument("--presets", help="JSON file of extra color presets to register")
+    parser.add_argument("-i", "--incremental", nargs="?", const="", metavar="MANIFEST",
+                        help=f"skip files already processed with the same effects and unchanged since, tracked in MANIFEST (default: {manifest.MANIFEST_NAME} in the output folder or the current folder)")
+    parser.add_argument("--events", nargs="?", const=instrumentation.DEFAULT_EVENTS_PATH, metavar="PATH",
+                        help=f"log timing and memory events as JSON lines (default: {instrumentation.DEFAULT_EVENTS_PATH})")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only report errors and the final summary")
+    return parser
+
+
+# The folder part of a glob pattern before its first wildcard, e.g. "photos" for "photos/**/*.jpg"
+def glob_base(pattern):
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    if parts == [""]:
+        # A pattern right under the root folder
+        return os.sep
+    return os.sep.join(parts) or "."
+
+
+# Expand the inputs into (image path, folder it was found under or None), without duplicates.
+# Glob matches are found under the glob's folder part (see glob_base).
+# Folder and glob matches for which is_output(path) is true (our own results) are left out.
+def collect_inputs(sources, recursive=False, stdin=sys.stdin, is_output=batch.is_processed_name):
+    found = []
+    for source in sources:
+        if source == "-":
+            found.extend((line.strip(), None) for line in stdin if line.strip())
+        elif os.path.isdir(source):
+            if recursive:
+                for folder, subfolders, files in os.walk(source):
+                    subfolders.sort()
+                    found.extend((os.path.join(folder, f), source) for f in sorted(files) if f.lower().endswith(batch.IMAGE_EXTENSIONS) and not is_output(os.path.join(folder, f)))
+            else:
+                found.extend((path, source) for path in batch.list_images(source) if not is_output(path))
+        elif glob.has_magic(source):
+            found.extend((path, glob_base(source)) for path in sorted(glob.glob(source, recursive=True)) if os.path.isfile(path) and path.lower().endswith(batch.IMAGE_EXTENSIONS) and not is_output(path))
+        else:
+            # Plain paths are passed through so that a missing file is reported as an error
+            found.append((source, None))
+    seen = set()
+    return [(path, root) for path, root in found if not (path in seen or seen.add(path))]
+
+
+# Where the result of `path` is written
+def output_path_for(path, root, output_dir=None, output_format=None, suffix=None):
+    base, extension = os.path.splitext(path)
+    extension = f".{output_format}" if output_format else extension
+    if output_dir is None:
+        return f"{base}{batch.PROCESSED_SUFFIX if suffix is None else suffix}{extension}"
+    relative = os.path.relpath(base, root) if root else os.path.basename(base)
+    return os.path.join(output_dir, f"{relative}{suffix or ''}{extension}")
+
+
+# Why these outputs cannot be written (an input overwritten, or two results at the same path), or None
+def output_conflict(outputs):
+    owners = {}
+    for path, output in outputs:
+        key = os.path.normcase(os.path.abspath(output))
+        if key == os.path.normcase(os.path.abspath(path)):
+            return f"the result of {path} would overwrite it; choose another --output-dir or a --suffix"
+        if key in owners:
+            return f"the results of {owners[key]} and {path} would both be written to {output}"
+        owners[key] = path
+    return None
+
+
+# Headless entry point; returns the process exit code (0 when every file was processed)
+def run_headless(argv):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    for option in ("workers", "readers", "writers"):
+        if getattr(args, option) is not None and getattr(args, option) < 1:
+            parser.error(f"--{option} must be at least 1")
+    if args.events:
+        instrumentation.log_to_file(args.events)
+    if args.integer_kernels:
+        kernels.set_integer_mode(True)
+    if args.presets:
+        try:
+            presets.load_presets(args.presets)
+        except (OSError, ValueError) as e:
+            parser.error(f"could not load presets from {args.presets}: {e}")
+    if not args.effects and not args.export_mask:
+        parser.error("give at least one --effect or --export-mask")
+    try:
+        steps = [parse_effect(values) for values in args.effects]
+    except ValueError as e:
+        parser.error(str(e))
+
+    run_manifest = None
+    if args.incremental is not None:
+        manifest_path = args.incremental or os.path.join(args.output_dir or ".", manifest.MANIFEST_NAME)
+        try:
+            run_manifest = manifest.Manifest(manifest_path)
+        except (OSError, ValueError) as e:
+            parser.error(f"could not read the manifest {manifest_path}: {e}")
+
+    # Our own results are told apart from inputs by their suffix, their folder or the manifest
+    suffix = batch.PROCESSED_SUFFIX if args.suffix is None and args.output_dir is None else args.suffix
+    output_root = os.path.join(os.path.abspath(args.output_dir), "") if args.output_dir else None
+
+    def is_output(path):
+        if batch.is_processed_name(path) or suffix and os.path.splitext(path)[0].endswith(suffix) or os.path.splitext(path)[0].endswith(masks.MASK_SUFFIX):
+            return True
+        if output_root and os.path.abspath(path).startswith(output_root):
+            return True
+        return run_manifest is not None and run_manifest.is_output(path)
+
+    image_paths = collect_inputs(args.inputs, args.recursive, is_output=is_output)
+    if not image_paths:
+        print("No images found.")
+        return 1
+    # Loose files (plain paths, stdin) keep their folders below the one they all have in common
+    loose = [os.path.dirname(os.path.abspath(path)) for path, root in image_paths if root is None]
+    try:
+        loose_root = os.path.commonpath(loose) if loose else None
+    except ValueError:
+        # Paths on different drives have no common folder
+        loose_root = None
+    image_paths = [(path, loose_root if root is None else root) for path, root in image_paths]
+    outputs = {path: output_path_for(path, root, args.output_dir, args.format, args.suffix) for path, root in image_paths}
+    mask_outputs = {path: output_path_for(path, root, args.output_dir, "png", masks.MASK_SUFFIX) for path, root in image_paths} if args.export_mask else {}
+    conflict = output_conflict(list(outputs.items()) + list(mask_outputs.items()))
+    if conflict:
+        parser.error(conflict)
+    for folder in {os.path.dirname(output) for output in list(outputs.values()) + list(mask_outputs.values())}:
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def report(index, total, image_path, error):
+        if error is not None or not args.quiet:
+            batch.print_progress(index, total, image_path, error)
+
+    failed_masks = 0
+    if mask_outputs:
+        failed_masks = export_masks(mask_outputs, args.export_mask, report)
+        print(f"Exported {len(mask_outputs) - failed_masks} of {len(mask_outputs)} masks ({failed_masks} failed).")
+        if not steps:
+            return 1 if failed_masks else 0
+
+    results = batch.batch_process(list(outputs), steps, output_path=outputs.__getitem__, workers=args.workers, progress=report, manifest=run_manifest,
+                                  staged=args.staged, readers=args.readers, writers=args.writers, profile=args.profile)
+    failed = sum(1 for _, error in results if error is not None)
+    print(f"Processed {len(results) - failed} of {len(results)} images ({failed} failed).")
+    return 1 if failed or failed_masks else 0
+
+
+# Write the mask of a criterion for each input (input path -> mask path); returns the number of failures
+def export_masks(mask_outputs, criterion, report):
+    failed = 0
+    for index, (image_path, mask_path) in enumerate(mask_outputs.items()):
+        error = None
+        try:
+            with Image.open(image_path) as img:
+                rgb, _ = kernels.to_array(img)
+            masks.save_mask(masks.compute_mask(rgb, criterion), mask_path)
+        except Exception as e:
+            error = e
+            failed += 1
+        report(index, len(mask_outputs), image_path, error)
+    return failed
+
+
 # Main function to run the program
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(run_headless(sys.argv[1:]))
     while True:
         color_shift_instance = ColorShift()
         if color_shift_instance.user_option != 5:
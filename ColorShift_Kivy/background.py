@@ -0,0 +1,131 @@
+# background.py
+# Replace only the near-black background connected to the image border, leaving dark regions
+# inside the subject alone. The connected dark area is found with a vectorized scanline pass:
+# the dark runs of every row, the overlaps of runs in neighbouring rows, and a union-find over runs.
+import numpy as np
+from PIL import Image, ImageFilter
+
+import kernels
+
+DEFAULT_THRESHOLD = 30
+DEFAULT_FEATHER = 0
+
+
+# Pixels whose channels are all below the threshold, as a (height, width) bool array
+def dark_mask(rgb, threshold=DEFAULT_THRESHOLD):
+    dark = np.empty(rgb.shape[:2], dtype=bool)
+    rows = max(1, kernels.CHUNK_PIXELS // max(1, rgb.shape[1]))
+    for top in range(0, len(rgb), rows):
+        band = rgb[top:top + rows]
+        np.less(band[..., 0], threshold, out=dark[top:top + rows])
+        dark[top:top + rows] &= band[..., 1] < threshold
+        dark[top:top + rows] &= band[..., 2] < threshold
+    return dark
+
+
+# Runs of True in each row: (rows, starts, ends) with ends exclusive, in row-major order
+def _row_runs(mask):
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+
+# Pairs (run, run in the row above) that share a column (4-connectivity). Runs of a row are
+# disjoint and sorted, so the runs above that overlap run i are a contiguous range found by two
+# binary searches over row-major keys.
+def _overlapping_runs(rows, starts, ends, width):
+    stride = width + 1
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    above = (rows - 1) * stride
+    first = np.searchsorted(end_keys, above + starts, side="right")
+    last = np.searchsorted(start_keys, above + ends, side="left")
+    counts = np.where(rows > 0, np.maximum(last - first, 0), 0)
+    total = int(counts.sum())
+    runs = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return runs, np.repeat(first, counts) + offsets
+
+
+# Component of every run: each run points at the smallest run of its component
+def _components(count, a, b):
+    parent = np.arange(count)
+    while True:
+        # Point every run straight at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        root_a, root_b = parent[a], parent[b]
+        joined = root_a != root_b
+        if not joined.any():
+            return parent
+        a, b = a[joined], b[joined]
+        root_a, root_b = root_a[joined], root_b[joined]
+        # Hook the larger root under the smaller one; roots only ever decrease, so no cycles
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+
+
+# Dark pixels connected to the image border through other dark pixels, as a (height, width) bool array
+def border_connected_mask(rgb, threshold=DEFAULT_THRESHOLD):
+    return border_connected_dark(dark_mask(rgb, threshold))
+
+
+# Part of a dark mask connected to the image border, e.g. from dark_mask() rows gathered strip by strip
+def border_connected_dark(dark):
+    height, width = dark.shape
+    rows, starts, ends = _row_runs(dark)
+    if len(rows) == 0:
+        return np.zeros((height, width), dtype=bool)
+    parent = _components(len(rows), *_overlapping_runs(rows, starts, ends, width))
+    on_border = (rows == 0) | (rows == height - 1) | (starts == 0) | (ends == width)
+    keep = np.isin(parent, np.unique(parent[on_border]))
+    # Paint the kept runs back: +1 at each start, -1 at each end, then a running sum
+    marks = np.zeros(height * width + 1, dtype=np.int8)
+    marks[rows[keep] * width + starts[keep]] += 1
+    marks[rows[keep] * width + ends[keep]] -= 1
+    return np.cumsum(marks[:-1], dtype=np.int8).view(bool).reshape(height, width)
+
+
+# Paint the masked background of rgb with a flat color (in place). `mask` covers the whole image and
+# rgb holds its rows [top, top + len(rgb)), so strips share one mask. With feather > 0 the mask is box
+# blurred by that many pixels and the color blended in by its weight, softening the edge.
+def fill_background(rgb, color, mask, feather=DEFAULT_FEATHER, top=0):
+    color = [min(255, max(0, int(c))) for c in color[:3]]
+    bottom = top + len(rgb)
+    if feather <= 0:
+        # One masked copy per channel plane is far cheaper than a boolean-indexed pixel assignment
+        rows = mask[top:bottom]
+        for channel, value in enumerate(color):
+            np.copyto(rgb[..., channel], value, where=rows)
+        return rgb
+    # Blur a slice with enough rows around the strip that its own rows come out as in the full blur
+    halo = feather + 1
+    read_top, read_bottom = max(0, top - halo), min(len(mask), bottom + halo)
+    soft = Image.fromarray(mask[read_top:read_bottom].view(np.uint8) * np.uint8(255)).filter(ImageFilter.BoxBlur(feather))
+    weights = np.asarray(soft)[top - read_top:bottom - read_top]
+    # Blend each channel plane over row bands and copy it back where the weight is not 0, instead of
+    # gathering and scattering the edge pixels with boolean fancy indexing. A weight of 255 gives the
+    # flat color exactly, so fully covered pixels need no separate pass.
+    rows = max(1, kernels.CHUNK_PIXELS // max(1, rgb.shape[1]))
+    for band_top in range(0, len(rgb), rows):
+        band = rgb[band_top:band_top + rows]
+        weight = weights[band_top:band_top + rows].astype(np.uint16)
+        covered = weight > 0
+        if not covered.any():
+            continue
+        inverse = 255 - weight
+        for channel, value in enumerate(color):
+            plane = band[..., channel]
+            np.copyto(plane, kernels.div255(plane * inverse + weight * value), where=covered, casting="unsafe")
+    return rgb
+
+
+# Recolor the near-black background connected to the border (in place)
+def replace_border_background(rgb, color, threshold=DEFAULT_THRESHOLD, feather=DEFAULT_FEATHER):
+    return fill_background(rgb, color, border_connected_mask(rgb, threshold), feather)
@@ -0,0 +1,285 @@
+# batch.py
+# Run an effect chain over many images on a pool of worker processes, or on overlapped I/O and compute threads
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+import encoders
+import instrumentation
+import kernels
+import presets
+import streaming
+from manifest import file_hash
+from pipeline import Pipeline
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Images at least this large are processed strip by strip to bound worker memory
+STREAM_ABOVE_PIXELS = 100_000_000
+
+# One pipeline per worker process and chain, so compiled LUTs are reused across files
+_pipelines = {}
+
+
+PROCESSED_SUFFIX = "-Processed"
+
+# Threads of each I/O stage of a staged run; compute threads default to one per CPU
+STAGED_READERS = 2
+STAGED_WRITERS = 2
+
+# Save the manifest of an incremental run after this many processed files, so a killed run keeps its progress
+MANIFEST_SAVE_EVERY = 1000
+
+
+# Default output name: same folder, "-Processed" appended to the file name
+def processed_path(image_path):
+    root, ext = os.path.splitext(image_path)
+    return f"{root}{PROCESSED_SUFFIX}{ext}"
+
+
+# True for files named like the default outputs, which must never be processed again as inputs
+def is_processed_name(image_path):
+    return os.path.splitext(image_path)[0].endswith(PROCESSED_SUFFIX)
+
+
+# List the images of a folder in a stable order, leaving out our own outputs
+def list_images(folder_path):
+    return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(IMAGE_EXTENSIONS) and not is_processed_name(f))
+
+
+# Worker side: errors are returned rather than raised so one bad file never stops the batch
+def _process_file(image_path, output_path, steps, stream_above=STREAM_ABOVE_PIXELS, profile=encoders.DEFAULT_PROFILE):
+    try:
+        steps = tuple(steps)
+        with Image.open(image_path) as img:
+            width, height = img.size
+        with instrumentation.operation("process_file", (width, height), path=str(image_path)):
+            if width * height >= stream_above:
+                streaming.stream_process(image_path, output_path, steps, profile=profile)
+                return None
+            if steps not in _pipelines:
+                _pipelines[steps] = Pipeline(steps)
+            _pipelines[steps].process(image_path, output_path, profile)
+        return None
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+# Default progress report, mirroring the old single-core loop
+def print_progress(index, total, image_path, error):
+    if error is None:
+        print(f"[{index + 1}/{total}] Processed {image_path}.")
+    else:
+        print(f"[{index + 1}/{total}] Skipping {image_path} due to error: {error}")
+
+
+# Process every image with the given steps.
+# At most max_in_flight files are queued or being decoded at once, which bounds memory,
+# and progress is reported in input order. Returns a list of (image_path, error or None).
+# With a manifest (see manifest.py) the run is incremental: files already processed with the same
+# steps and unchanged since are skipped and left out of the results, as are the manifest's outputs.
+# staged=True runs the batch in this process with overlapped reader, compute and writer threads
+# (see staged_batch_process) instead of a pool of worker processes.
+# Outputs are encoded with the options of the named output profile (see encoders.py).
+def batch_process(image_paths, steps, output_path=processed_path, workers=None, max_in_flight=None, progress=print_progress, manifest=None, staged=False, readers=STAGED_READERS, writers=STAGED_WRITERS,
+                  profile=encoders.DEFAULT_PROFILE):
+    image_paths = list(image_paths)
+    steps = presets.resolve_presets(steps)
+    if manifest is not None:
+        return _batch_process_incremental(image_paths, steps, output_path, progress, manifest,
+                                          dict(workers=workers, max_in_flight=max_in_flight, staged=staged, readers=readers, writers=writers, profile=profile))
+    if staged:
+        return staged_batch_process(image_paths, steps, output_path, readers, workers, writers, max_in_flight, progress, profile=profile)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    total = len(image_paths)
+    results = []
+    pending = deque()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        next_index = 0
+        while next_index < total or pending:
+            while next_index < total and len(pending) < max_in_flight:
+                path = image_paths[next_index]
+                pending.append((path, executor.submit(_process_file, path, output_path(path), steps, STREAM_ABOVE_PIXELS, profile)))
+                next_index += 1
+            path, future = pending.popleft()
+            try:
+                error = future.result()
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for running out of memory) and broke the pool, failing every
+                # file still in it. Which file killed it is unknown, so each unfinished one is rerun alone
+                # in a pool of one: only a file that kills its own worker fails. Then a new pool carries on.
+                executor.shutdown(wait=False, cancel_futures=True)
+                pending.appendleft((path, future))
+                pending = deque((p, _settled(f, p, output_path(p), steps, profile)) for p, f in pending)
+                executor = ProcessPoolExecutor(max_workers=workers)
+                path, future = pending.popleft()
+                error = future.result()
+            results.append((path, error))
+            if progress:
+                progress(len(results) - 1, total, path, error)
+    finally:
+        executor.shutdown()
+    return results
+
+
+# `future` if its file finished before the pool broke, else a future holding the result of the file
+# processed again on its own
+def _settled(future, image_path, output_path, steps, profile):
+    if future.done() and not future.cancelled() and future.exception() is None:
+        return future
+    settled = Future()
+    with ProcessPoolExecutor(max_workers=1) as alone:
+        try:
+            settled.set_result(alone.submit(_process_file, image_path, output_path, steps, STREAM_ABOVE_PIXELS, profile).result())
+        except BrokenProcessPool as e:
+            settled.set_result(f"{type(e).__name__}: {e}")
+    return settled
+
+
+def _batch_process_incremental(image_paths, steps, output_path, progress, manifest, options):
+    # Outputs encoded with another profile are out of date too (default-profile entries keep their old key)
+    chain = steps if options["profile"] == encoders.DEFAULT_PROFILE else steps + (("output_profile", options["profile"]),)
+    # So are outputs made with the other kernel mode (see kernels.py)
+    if kernels.integer_mode():
+        chain += (("integer_kernels",),)
+    # And outputs masked with a mask file that has changed since (see masks.py)
+    chain += tuple(("mask_file", step[2], file_hash(step[2])) for step in steps if step[0] == "apply_mask" and isinstance(step[2], str))
+    todo = [path for path in image_paths if not manifest.is_output(path) and not manifest.is_current(path, chain, output_path(path))]
+    print(f"Skipping {len(image_paths) - len(todo)} up-to-date images and outputs, processing {len(todo)}.")
+    processed = 0
+
+    def record(index, total, image_path, error):
+        nonlocal processed
+        if error is None:
+            try:
+                manifest.record(image_path, chain, output_path(image_path))
+            except OSError as e:
+                # Input gone or unreadable after processing: it is simply processed again next run
+                print(f"Could not record {image_path} in the manifest: {e}")
+            processed += 1
+            if processed % MANIFEST_SAVE_EVERY == 0:
+                manifest.save()
+        if progress:
+            progress(index, total, image_path, error)
+
+    try:
+        return batch_process(todo, steps, output_path, progress=record, **options)
+    finally:
+        manifest.save()
+
+
+# Stage threads pass this down the queues when their stage is finished
+_STAGE_DONE = object()
+
+
+# Run `count` threads of `function(item)` between two bounded queues. Each result is put on `outbox`;
+# the last thread to finish passes `next_count` end markers on so the next stage stops too.
+def _start_stage(name, count, function, inbox, outbox, next_count, stop):
+    remaining = [count]
+    lock = threading.Lock()
+
+    def run():
+        while not stop.is_set():
+            item = inbox.get()
+            if item is _STAGE_DONE:
+                break
+            outbox.put(function(item))
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(next_count):
+                outbox.put(_STAGE_DONE)
+
+    threads = [threading.Thread(target=run, name=f"{name}-{i}", daemon=True) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# Overlapped batch: reader threads decode ahead, compute threads run the chain, writer threads encode
+# and save. Pillow and NumPy release the GIL while decoding, filtering and encoding, so the disk and
+# the CPU work at the same time. The bounded queues hold at most max_in_flight decoded and processed
+# images each, which is the backpressure that bounds memory. Errors are isolated per file and
+# progress is reported in input order, like batch_process.
+def staged_batch_process(image_paths, steps, output_path=processed_path, readers=STAGED_READERS, compute=None, writers=STAGED_WRITERS,
+                         max_in_flight=None, progress=print_progress, stream_above=STREAM_ABOVE_PIXELS, profile=encoders.DEFAULT_PROFILE):
+    image_paths = list(image_paths)
+    steps = tuple(tuple(step) for step in steps)
+    compute = compute or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * compute
+    pipeline = Pipeline(steps)
+    stop = threading.Event()
+
+    # Each item is (index, path, image or None, error or None)
+    def read(item):
+        index, path = item
+        try:
+            with Image.open(path) as source:
+                if source.width * source.height >= stream_above:
+                    # Too large to hold decoded: the compute stage streams it from disk to disk
+                    return index, path, None, None
+                with instrumentation.timed_io("load", path):
+                    return index, path, source.convert("RGB"), None
+        except Exception as e:
+            return index, path, None, f"{type(e).__name__}: {e}"
+
+    def process(item):
+        index, path, img, error = item
+        if error is not None:
+            return item
+        try:
+            if img is None:
+                streaming.stream_process(path, output_path(path), steps, profile=profile)
+                return index, path, None, None
+            return index, path, pipeline.run(img), None
+        except Exception as e:
+            return index, path, None, f"{type(e).__name__}: {e}"
+
+    def write(item):
+        index, path, result, error = item
+        if error is None and result is not None:
+            try:
+                encoders.save_image(result, output_path(path), profile)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        return index, path, error
+
+    paths = queue.Queue()
+    for item in enumerate(image_paths):
+        paths.put(item)
+    for _ in range(readers):
+        paths.put(_STAGE_DONE)
+    decoded = queue.Queue(maxsize=max_in_flight)
+    processed = queue.Queue(maxsize=max_in_flight)
+    finished = queue.Queue()
+    _start_stage("reader", readers, read, paths, decoded, compute, stop)
+    _start_stage("compute", compute, process, decoded, processed, writers, stop)
+    _start_stage("writer", writers, write, processed, finished, 1, stop)
+
+    total = len(image_paths)
+    errors = [None] * total
+    done = [False] * total
+    reported = 0
+    try:
+        while True:
+            item = finished.get()
+            if item is _STAGE_DONE:
+                break
+            index, _, error = item
+            errors[index], done[index] = error, True
+            # Report in input order as soon as every earlier file is finished
+            while reported < total and done[reported]:
+                if progress:
+                    progress(reported, total, image_paths[reported], errors[reported])
+                reported += 1
+    finally:
+        stop.set()
+    return list(zip(image_paths, errors))
@@ -1,21 +1,39 @@
 # color_shift.py
-from PIL import Image, ImageFilter, ImageDraw, ImageEnhance
+from PIL import ImageFilter, ImageEnhance
+import background
+import encoders
+import filters
+import gradients
+import instrumentation
+import kernels
+import lut
+import masks
+from image_cache import image_cache
+from masks import mask_cache
+from prefix_cache import prefix_cache, source_key
 
 class ColorShift:
     def __init__(self, image_path):
         self.image_path = image_path
-        self.img = self.load_image().convert("RGB")
+        self.img = self.load_image()
+        # The decoded pixels are shared through the cache, so in-place edits copy them first
+        self.shared_img = self.img
+        self.source_img = self.img
 
-    # Load the image
+    # Load the image (decoded once per file version, see image_cache.py)
     def load_image(self):
         try:
-            img = Image.open(self.image_path)
+            hits = image_cache.hits
+            with instrumentation.timed_io("load", self.image_path) as event:
+                img = image_cache.get(self.image_path)
+                event["cached"] = image_cache.hits > hits
             return img
         except FileNotFoundError:
             print(f"Image not found at {self.image_path}")
             return None
 
     # Convert the image to black and white
+    @instrumentation.instrumented
     def convert_to_black_and_white(self):
         if self.img:
             self.img = self.img.convert("L").convert("RGB")  # Convert to grayscale and back to RGB
@@ -25,6 +43,7 @@ class ColorShift:
             return None
     
     # Apply sharpen or blur
+    @instrumentation.instrumented
     def apply_sharpen_blur(self, effect):
         if effect == "sharpen":
             self.img = self.img.filter(ImageFilter.SHARPEN)
@@ -32,50 +51,50 @@ class ColorShift:
             self.img = self.img.filter(ImageFilter.BLUR)
         print(f"Applied {effect} effect.")
 
-    # Apply gradient
-    def apply_gradient(self, color1, color2):
-        width, height = self.img.size
-        gradient = Image.new('RGB', (width, height))
-        draw = ImageDraw.Draw(gradient)
-        for i in range(height):
-            r = int(color1[0] + (color2[0] - color1[0]) * i / height)
-            g = int(color1[1] + (color2[1] - color1[1]) * i / height)
-            b = int(color1[2] + (color2[2] - color1[2]) * i / height)
-            draw.line([(0, i), (width, i)], fill=(r, g, b))
-        self.img = Image.blend(self.img, gradient, alpha=0.5)
+    # Gaussian blur with a radius in pixels (the standard deviation); costs the same at any radius
+    @instrumentation.instrumented
+    def apply_gaussian_blur(self, radius):
+        self.apply_filter("apply_gaussian_blur", radius)
+        print(f"Applied a Gaussian blur of radius {radius}.")
+
+    # Box blur: the mean of the (2 * radius + 1)-pixel square around each pixel
+    @instrumentation.instrumented
+    def apply_box_blur(self, radius):
+        self.apply_filter("apply_box_blur", radius)
+        print(f"Applied a box blur of radius {radius}.")
+
+    # Unsharp mask: add back percent of the difference to a Gaussian blur of the radius, where it exceeds the threshold
+    @instrumentation.instrumented
+    def apply_unsharp_mask(self, radius, percent=filters.DEFAULT_PERCENT, threshold=filters.DEFAULT_THRESHOLD):
+        self.apply_filter("apply_unsharp_mask", radius, percent, threshold)
+        print(f"Applied an unsharp mask of radius {radius}.")
+
+    # Run a variable-radius filter in row tiles (see filters.py)
+    def apply_filter(self, name, *params):
+        params = filters.normalize(name, params)
+        if filters.is_identity(name, params):
+            return
+        rgb, alpha = kernels.to_array(self.img)
+        self.img = kernels.from_array(filters.apply(rgb, name, params), alpha)
+
+    # Apply gradient (shape: vertical, horizontal, diagonal or radial; alpha is the gradient's weight)
+    @instrumentation.instrumented
+    def apply_gradient(self, color1, color2, shape="vertical", alpha=gradients.DEFAULT_ALPHA):
+        self.img = gradients.blend_gradient_image(self.img, color1, color2, shape, alpha)
         print("Gradient applied.")
         print("Applied gradient effect.")
 
     # Apply color preset
+    @instrumentation.instrumented
     def apply_color_preset(self, preset):
-        valid_presets = ["warm", "cool", "vintage", "sepia"]
-        while preset not in valid_presets:
-            preset = input(f"Invalid preset. Choose one from {valid_presets}: ")
-        if preset == 'sepia':
-            sepia_filter = [(int(r * 0.393 + g * 0.769 + b * 0.189),
-                            int(r * 0.349 + g * 0.686 + b * 0.168),
-                            int(r * 0.272 + g * 0.534 + b * 0.131))
-                            for (r, g, b) in self.img.getdata()]
-            self.img.putdata(sepia_filter)
-            print("Sepia preset applied.")
-        elif preset == 'cool':
-            cool_filter = [(int(r * 0.8), int(g * 0.9), int(b * 1.1)) for (r, g, b) in self.img.getdata()]
-            self.img.putdata(cool_filter)
-            print("Cool preset applied.")
-        elif preset == 'warm':
-            warm_filter = [(int(r * 1.1), int(g * 0.9), int(b * 0.8)) for (r, g, b) in self.img.getdata()]
-            self.img.putdata(warm_filter)
-            print("Warm preset applied.")
-        elif preset == 'vintage':
-            vintage_filter = [(int(r * 0.9 + g * 0.7 + b * 0.4),
-                            int(r * 0.6 + g * 0.5 + b * 0.3),
-                            int(r * 0.3 + g * 0.2 + b * 0.1))
-                            for (r, g, b) in self.img.getdata()]
-            self.img.putdata(vintage_filter)
-            print("Vintage preset applied.")
+        rgb, alpha = kernels.to_array(self.img)
+        kernels.apply_color_preset(rgb, preset)
+        self.img = kernels.from_array(rgb, alpha)
+        print(f"{preset.capitalize()} preset applied.")
         print(f"Applied {preset} preset.")
 
     # Adjust contrast and brightness
+    @instrumentation.instrumented
     def adjust_contrast_brightness(self, contrast_factor, brightness_factor):
         enhancer_contrast = ImageEnhance.Contrast(self.img)
         self.img = enhancer_contrast.enhance(contrast_factor)
@@ -83,45 +102,94 @@ class ColorShift:
         self.img = enhancer_brightness.enhance(brightness_factor)
 
     # Apply transparency
+    @instrumentation.instrumented
     def apply_transparency(self, transparency_level):
-        while not (0 <= transparency_level <= 255):
-            transparency_level = int(input("Enter a valid transparency level (0 to 255): "))
+        if self.img is self.shared_img:
+            self.img = self.img.copy()
         self.img.putalpha(transparency_level)
         print("Transparency applied successfully.")
 
-    # Apply color mask
-    def apply_color_mask(self, mask_color):
-        data = self.img.getdata()
-        new_image_data = [(mask_color if (r < 100 and g < 100 and b < 100) else (r, g, b)) for (r, g, b) in data]
-        self.img.putdata(new_image_data)
+    # Apply color mask (by default to the dark areas, see masks.py for the other criteria)
+    @instrumentation.instrumented
+    def apply_color_mask(self, mask_color, criterion=masks.COLOR_MASK):
+        self.paint_mask(mask_color, criterion)
         print("Color mask applied successfully.")
 
+    # Key of the current pixels: the file version while they are the decoded file, else their hash
+    def image_key(self):
+        return source_key(self.img, self.image_path if self.img is self.source_img else None)
+
+    # Mask of the current image for a criterion or mask file; cached per image, so recoloring the
+    # same mask with another color only costs the composite
+    def mask(self, source=masks.COLOR_MASK):
+        return mask_cache.mask_for(self.image_key(), masks.normalize(source), self.img)
+
+    # Paint the pixels of a mask (criterion or exported mask file) with a flat color
+    @instrumentation.instrumented
+    def apply_mask(self, mask_color, source=masks.COLOR_MASK):
+        self.paint_mask(mask_color, source)
+        print("Mask applied successfully.")
+
+    def paint_mask(self, mask_color, source):
+        mask = self.mask(source)
+        rgb, alpha = kernels.to_array(self.img)
+        masks.composite(rgb, mask, mask_color)
+        self.img = kernels.from_array(rgb, alpha)
+
+    # Save the mask of a criterion as a 1-bit PNG, to apply to other images later
+    def export_mask(self, output_path, criterion=masks.COLOR_MASK):
+        masks.save_mask(self.mask(criterion), output_path)
+        print(f"Mask saved at {output_path}")
+
+    # Change the near-black background of the image
+    @instrumentation.instrumented
+    def change_black_background(self, new_bg_color):
+        rgb, alpha = kernels.to_array(self.img)
+        kernels.change_black_background(rgb, new_bg_color)
+        self.img = kernels.from_array(rgb, alpha)
+        print("Background color changed successfully.")
+
+    # Change only the near-black background connected to the image border, leaving dark areas
+    # inside the subject alone (feather > 0 softens the edge over that many pixels)
+    @instrumentation.instrumented
+    def replace_border_background(self, new_bg_color, threshold=background.DEFAULT_THRESHOLD, feather=background.DEFAULT_FEATHER):
+        rgb, alpha = kernels.to_array(self.img)
+        background.replace_border_background(rgb, new_bg_color, threshold, feather)
+        self.img = kernels.from_array(rgb, alpha)
+        print("Border background color changed successfully.")
+
     # Change a specific color within the image
+    @instrumentation.instrumented
     def change_color(self, target_color, color_to_change):
         try:
-            data = self.img.getdata()
-            new_image_data = []
-            for item in data:
-                r, g, b = item
-                color_map = {'r': r, 'g': g, 'b': b}
-                if color_map[color_to_change] >= color_map['r'] and color_map[color_to_change] >= color_map['g'] and color_map[color_to_change] >= color_map['b']:
-                    factor = color_map[color_to_change] / 255.0
-                    new_r = int((1 - factor) * r + factor * target_color[0])
-                    new_g = int((1 - factor) * g + factor * target_color[1])
-                    new_b = int((1 - factor) * b + factor * target_color[2])
-                    new_image_data.append((new_r, new_g, new_b))
-                else:
-                    new_image_data.append(item)
-            self.img.putdata(new_image_data)
+            rgb, alpha = kernels.to_array(self.img)
+            kernels.change_color(rgb, target_color, color_to_change)
+            self.img = kernels.from_array(rgb, alpha)
             print("Color changed successfully.")
         except Exception as e:
             print(f"Error occurred while processing the image: {e}")
 
 
-    # Save the modified image in a temporary file
-    def save_image(self, output_path):
+    # Apply a per-pixel operation through its compiled lookup table (tables are cached across images)
+    @instrumentation.instrumented
+    def apply_lut(self, operation, *params, size=lut.EXACT):
+        self.img = lut.apply_lut(self.img, operation, params, size)
+        print(f"Applied {operation} through a {size}x{size}x{size} LUT.")
+
+    # Apply an ordered list of (method name, *params) effects with fused runs (see pipeline.py).
+    # Results are cached by step prefix, so a chain that only differs in its late steps reuses
+    # the work of its early ones (see prefix_cache.py).
+    @instrumentation.instrumented
+    def apply_pipeline(self, steps):
+        key = self.image_key()
+        # The result may be a cached image, so it is shared too
+        self.img = self.shared_img = prefix_cache.render(key, self.img, steps)
+        print(f"Applied {len(steps)} stacked effects.")
+
+    # Save the modified image in a temporary file, encoded with an output profile (see encoders.py)
+    def save_image(self, output_path, profile=encoders.DEFAULT_PROFILE):
         if self.img:
-            self.img.save(output_path)
+            encoders.save_image(self.img, output_path, profile)
             print(f"Temporary image saved at {output_path}")
         else:
             print("No image to save.")
@@ -0,0 +1,62 @@
+# encoders.py
+# Named output profiles: the Pillow save options of each output format, chosen per job
+import os
+
+from PIL import Image
+
+import instrumentation
+
+DEFAULT_PROFILE = "default"
+
+# Profile -> output format -> keyword arguments of Image.save (formats not listed use Pillow's defaults)
+PROFILES = {
+    # Pillow's own defaults, as before profiles existed
+    "default": {},
+    # Fastest encode for previews and intermediate files
+    "preview-fast": {
+        "PNG": {"compress_level": 1},
+        "JPEG": {"quality": 80},
+        "WEBP": {"quality": 75, "method": 0},
+        "TIFF": {"compression": "raw"},
+    },
+    # Smallest lossless files, whatever the encode time
+    "archive": {
+        "PNG": {"optimize": True},
+        "WEBP": {"lossless": True, "quality": 100, "method": 6},
+        "JPEG": {"quality": 95, "optimize": True, "subsampling": 0},
+        "TIFF": {"compression": "tiff_adobe_deflate"},
+    },
+    # Small files for the web: progressive JPEG / lossy WebP at a set quality
+    "web": {
+        "JPEG": {"quality": 82, "optimize": True, "progressive": True},
+        "WEBP": {"quality": 80, "method": 4},
+        "PNG": {"optimize": True},
+    },
+}
+
+
+def profile_names():
+    return list(PROFILES)
+
+
+# Pillow format name of an output path, e.g. "JPEG" for photo.jpg (None if unknown)
+def output_format(path):
+    extension = os.path.splitext(str(path))[1].lower()
+    # Pillow registers formats lazily, so the table may only hold the ones opened so far
+    if extension not in Image.EXTENSION:
+        Image.init()
+    return Image.EXTENSION.get(extension)
+
+
+# Image.save keyword arguments of a profile for the format of `path`
+def save_options(path, profile=DEFAULT_PROFILE):
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown output profile '{profile}'. Choose one from {profile_names()}")
+    return dict(PROFILES[profile].get(output_format(path), {}))
+
+
+# Save an image with the options of a profile, reported as an "io" event
+def save_image(img, path, profile=DEFAULT_PROFILE):
+    options = save_options(path, profile)
+    with instrumentation.timed_io("save", path, profile=profile):
+        img.save(path, **options)
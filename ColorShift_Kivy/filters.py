@@ -0,0 +1,81 @@
+# filters.py
+# Blur and sharpen filters with a variable radius. Pillow runs a box blur as a running sum and a
+# Gaussian blur (also the one inside an unsharp mask) as three box blurs, so the cost per pixel stays
+# flat as the radius grows. Images are filtered in row tiles, each read with enough rows of halo
+# around it that the tiles put together equal the whole image filtered at once.
+import math
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+import kernels
+
+# Pillow's UnsharpMask defaults
+DEFAULT_PERCENT = 150
+DEFAULT_THRESHOLD = 3
+
+# Box passes Pillow approximates a Gaussian with
+GAUSSIAN_PASSES = 3
+
+OPERATIONS = ("apply_gaussian_blur", "apply_box_blur", "apply_unsharp_mask")
+
+# Tiles are at least this many halos tall, so halo rows add at most 2 / TILE_HALOS to the work
+TILE_HALOS = 8
+
+
+# Parameters of a filter step with its defaults filled in, so equal filters compare equal
+def normalize(name, params):
+    radius = float(params[0])
+    if radius < 0:
+        raise ValueError(f"the radius of {name} must be 0 or more, got {params[0]}")
+    if name == "apply_unsharp_mask":
+        percent, threshold = (tuple(params[1:]) + (DEFAULT_PERCENT, DEFAULT_THRESHOLD)[len(params) - 1:])[:2]
+        return (radius, int(percent), int(threshold))
+    return (radius,)
+
+
+# True when the filter leaves every pixel as it is
+def is_identity(name, params):
+    return params[0] == 0 or name == "apply_unsharp_mask" and params[1] == 0
+
+
+def make_filter(name, params):
+    if name == "apply_gaussian_blur":
+        return ImageFilter.GaussianBlur(params[0])
+    if name == "apply_box_blur":
+        return ImageFilter.BoxBlur(params[0])
+    return ImageFilter.UnsharpMask(*params)
+
+
+# Radius of each box pass of a Gaussian blur, as Pillow computes it (_gaussian_blur_radius in BoxBlur.c)
+def _gaussian_box_radius(radius, passes=GAUSSIAN_PASSES):
+    sigma2 = radius * radius / passes
+    size = math.sqrt(12.0 * sigma2 + 1.0)
+    whole = math.floor((size - 1.0) / 2.0)
+    fraction = (2 * whole + 1) * (whole * (whole + 1) - 3 * sigma2)
+    fraction /= 6 * (sigma2 - (whole + 1) * (whole + 1))
+    return whole + fraction
+
+
+# Rows of context a filter reads on each side of a pixel: a box pass of radius r reaches int(r) + 1
+# rows (the outermost one with a fractional weight)
+def halo(name, params):
+    if name == "apply_box_blur":
+        return int(params[0]) + 1
+    return GAUSSIAN_PASSES * (int(_gaussian_box_radius(params[0])) + 1)
+
+
+# Filter an RGB array and return the result as a new array, in tiles of TILE_HALOS halos of rows or
+# about kernels.CHUNK_PIXELS pixels, whichever is taller
+def apply(rgb, name, params):
+    image_filter = make_filter(name, params)
+    context = halo(name, params)
+    height, width = rgb.shape[:2]
+    rows = max(TILE_HALOS * context, kernels.CHUNK_PIXELS // max(1, width))
+    out = np.empty_like(rgb)
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        read_top, read_bottom = max(0, top - context), min(height, bottom + context)
+        tile = Image.fromarray(np.ascontiguousarray(rgb[read_top:read_bottom])).filter(image_filter)
+        out[top:bottom] = np.asarray(tile)[top - read_top:bottom - read_top]
+    return out
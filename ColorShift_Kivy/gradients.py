@@ -0,0 +1,105 @@
+# gradients.py
+# Two-color gradient layers built from a 1-D ramp, cached by size, colors and shape
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+import kernels
+
+GRADIENT_SHAPES = ("vertical", "horizontal", "diagonal", "radial")
+DEFAULT_ALPHA = 0.5
+
+# Radial gradients look colors up in a ramp of this many entries
+RADIAL_STEPS = 1024
+
+# Whole-image layers kept for reuse (Pillow stores RGB at 4 bytes per pixel); the latest one is always kept
+LAYER_CACHE_BYTES = 256 * 1024 * 1024
+
+_layers = OrderedDict()  # (size, color1, color2, shape) -> RGB image, least recently used first
+_layers_lock = threading.Lock()
+
+
+# `length` colors going from color1 towards color2 as a read-only (length, 3) uint8 array.
+# Entry i is int(color1 + (color2 - color1) * i / length), the same math as the old per-row loop.
+@lru_cache(maxsize=32)
+def ramp(length, color1, color2):
+    start = np.array(color1[:3], dtype=np.int64)
+    steps = np.arange(length, dtype=np.int64)[:, None] * (np.array(color2[:3], dtype=np.int64) - start)
+    colors = (start + steps / length).astype(np.uint8)
+    colors.flags.writeable = False
+    return colors
+
+
+# Rows [top, bottom) of a radial gradient: color1 at the center, color2 towards the corners
+def _radial_rows(width, height, color1, color2, top, bottom):
+    y = np.arange(top, bottom, dtype=np.float64)[:, None] + 0.5 - height / 2
+    x = np.arange(width, dtype=np.float64)[None, :] + 0.5 - width / 2
+    distance = np.sqrt(x * x + y * y) / np.hypot(width / 2, height / 2)
+    index = np.minimum((distance * RADIAL_STEPS).astype(np.intp), RADIAL_STEPS - 1)
+    return ramp(RADIAL_STEPS, color1, color2)[index]
+
+
+# Rows [top, bottom) of the gradient layer of a (width, height) image, as an RGB image.
+# Linear shapes are a 1-D ramp stretched by Pillow, so no per-pixel work happens in Python.
+def render_rows(size, color1, color2, shape, top, bottom):
+    width, height = size
+    rows = bottom - top
+    if shape == "vertical":
+        return Image.fromarray(np.ascontiguousarray(ramp(height, color1, color2)[top:bottom, None, :])).resize((width, rows), Image.NEAREST)
+    if shape == "horizontal":
+        return Image.fromarray(np.ascontiguousarray(ramp(width, color1, color2)[None, :, :])).resize((width, rows), Image.NEAREST)
+    if shape == "diagonal":
+        # Pixel (x, y) takes ramp entry x + y, so every row is the ramp shifted by one entry
+        colors = ramp(width + height - 1, color1, color2)[top:]
+        stride = colors.strides[0]
+        return Image.fromarray(np.lib.stride_tricks.as_strided(colors, (rows, width, 3), (stride, stride, colors.strides[1])).copy())
+    if shape == "radial":
+        return Image.fromarray(_radial_rows(width, height, color1, color2, top, bottom))
+    raise ValueError(f"Unknown gradient shape '{shape}'. Choose one from {list(GRADIENT_SHAPES)}")
+
+
+# The whole gradient layer of a (width, height) image, shared between images of the same size.
+# The returned image must not be changed in place.
+def gradient_layer(size, color1, color2, shape="vertical"):
+    key = (tuple(size), tuple(int(c) for c in color1[:3]), tuple(int(c) for c in color2[:3]), shape)
+    with _layers_lock:
+        if key in _layers:
+            _layers.move_to_end(key)
+            return _layers[key]
+    layer = render_rows(*key, 0, size[1])
+    with _layers_lock:
+        _layers[key] = layer
+        while len(_layers) > 1 and sum(4 * img.width * img.height for img in _layers.values()) > LAYER_CACHE_BYTES:
+            _layers.popitem(last=False)
+    return layer
+
+
+# Blend the gradient over an image; alpha is the weight of the gradient, like Image.blend
+def blend_gradient_image(img, color1, color2, shape="vertical", alpha=DEFAULT_ALPHA):
+    img_alpha = img.getchannel("A") if img.mode == "RGBA" else None
+    layer = gradient_layer(img.size, color1, color2, shape)
+    if kernels.integer_mode():
+        result = Image.fromarray(kernels.blend_fixed(np.asarray(img.convert("RGB")), np.asarray(layer), alpha))
+    else:
+        result = Image.blend(img.convert("RGB"), layer, alpha)
+    if img_alpha is not None:
+        result.putalpha(img_alpha)
+    return result
+
+
+# Blend the gradient over rows [top, top + len(rgb)) of an image `height` rows tall and return
+# the new array. Strips are rendered on their own so streaming never holds a full-size layer.
+def blend_gradient(rgb, color1, color2, shape="vertical", alpha=DEFAULT_ALPHA, top=0, height=None):
+    height = len(rgb) if height is None else height
+    size = (rgb.shape[1], height)
+    color1, color2 = tuple(int(c) for c in color1[:3]), tuple(int(c) for c in color2[:3])
+    if top == 0 and len(rgb) == height:
+        layer = gradient_layer(size, color1, color2, shape)
+    else:
+        layer = render_rows(size, color1, color2, shape, top, top + len(rgb))
+    if kernels.integer_mode():
+        return kernels.blend_fixed(rgb, np.asarray(layer), alpha)
+    return np.array(Image.blend(kernels.from_array(rgb), layer, alpha))
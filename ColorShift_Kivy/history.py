@@ -0,0 +1,136 @@
+# history.py
+# Multi-level undo/redo of the Kivy app's edit stack. A state is the list of steps applied to the
+# source image (an operation record: the full-resolution frame is only rendered on Save) plus its
+# preview, kept zlib-compressed in memory up to a byte budget and spilled to disk past it.
+import os
+import shutil
+import tempfile
+import zlib
+
+from PIL import Image
+
+# Megabytes of compressed previews kept in memory, overridable with COLORSHIFT_HISTORY_MB
+HISTORY_BUDGET_ENV = "COLORSHIFT_HISTORY_MB"
+DEFAULT_MEMORY_BUDGET = int(os.environ.get(HISTORY_BUDGET_ENV, 64)) * 1024 * 1024
+DEFAULT_MAX_STATES = 100
+
+
+class Snapshot:
+    # A compressed preview, in memory or in a file of the spill folder
+    def __init__(self, img):
+        self.mode, self.size = img.mode, img.size
+        self.data = zlib.compress(img.tobytes(), 1)
+        self.path = None
+
+    @property
+    def memory_bytes(self):
+        return len(self.data) if self.data is not None else 0
+
+    def spill(self, folder):
+        fd, self.path = tempfile.mkstemp(suffix=".snapshot", dir=folder)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.data)
+        self.data = None
+
+    def image(self):
+        data = self.data
+        if data is None:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        return Image.frombytes(self.mode, self.size, zlib.decompress(data))
+
+    def discard(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class EditHistory:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, max_states=DEFAULT_MAX_STATES):
+        self.memory_budget = memory_budget
+        self.max_states = max_states
+        self.states = []  # (steps, names, Snapshot), oldest first
+        self.position = -1
+        self.spill_folder = None
+
+    # Start over from an unedited preview
+    def reset(self, preview):
+        self.discard(self.states)
+        self.states = [((), (), Snapshot(preview))]
+        self.position = 0
+
+    # Record one more applied step and the preview it gave; states that could be redone are dropped
+    def push(self, step, name, preview):
+        steps, names, _ = self.states[self.position]
+        self.discard(self.states[self.position + 1:])
+        self.states = self.states[:self.position + 1]
+        self.states.append((steps + (step,), names + (name,), Snapshot(preview)))
+        # Past max_states the oldest previews go, but every state keeps its whole step list
+        if len(self.states) > self.max_states:
+            self.discard(self.states[:1])
+            self.states = self.states[1:]
+        self.position = len(self.states) - 1
+        self.enforce_budget()
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.states) - 1
+
+    def undo(self):
+        if self.can_undo():
+            self.position -= 1
+        return self.preview
+
+    def redo(self):
+        if self.can_redo():
+            self.position += 1
+        return self.preview
+
+    @property
+    def steps(self):
+        return list(self.states[self.position][0])
+
+    @property
+    def names(self):
+        return list(self.states[self.position][1])
+
+    @property
+    def preview(self):
+        return self.states[self.position][2].image()
+
+    def memory_bytes(self):
+        return sum(snapshot.memory_bytes for _, _, snapshot in self.states)
+
+    # Spill the snapshots farthest from the current state to disk until the rest fit the budget
+    def enforce_budget(self):
+        if self.memory_bytes() <= self.memory_budget:
+            return
+        if self.spill_folder is None:
+            self.spill_folder = tempfile.mkdtemp(prefix="colorshift-history-")
+        by_distance = sorted(range(len(self.states)), key=lambda i: abs(i - self.position), reverse=True)
+        total = self.memory_bytes()
+        for i in by_distance:
+            if total <= self.memory_budget or i == self.position:
+                break
+            snapshot = self.states[i][2]
+            if snapshot.data is not None:
+                total -= snapshot.memory_bytes
+                snapshot.spill(self.spill_folder)
+
+    @staticmethod
+    def discard(states):
+        for _, _, snapshot in states:
+            snapshot.discard()
+
+    # Remove every spilled snapshot
+    def close(self):
+        self.discard(self.states)
+        self.states = []
+        self.position = -1
+        if self.spill_folder is not None:
+            shutil.rmtree(self.spill_folder, ignore_errors=True)
+            self.spill_folder = None
@@ -0,0 +1,113 @@
+# image_cache.py
+# Decoded source images shared across effect applications, bounded by total bytes with LRU eviction.
+# Screen-sized previews (decoded at reduced scale for JPEGs) are cached next to the full images.
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class DecodedImageCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # (path, mtime) -> RGB image, or (path, mtime, preview size) -> preview; least recently used first
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(img):
+        return img.width * img.height * len(img.getbands())
+
+    # Return the decoded RGB pixels of a file. The image is shared: callers must copy it
+    # before changing it in place.
+    def get(self, path):
+        path = os.path.abspath(path)
+        key = (path, os.path.getmtime(path))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        with Image.open(path) as source:
+            img = source.convert("RGB")
+        self.put(key, img)
+        return img
+
+    # Return pixels of a file for display within max_size (width, height): at least the fitted size and
+    # less than twice it, so callers still resize to the exact size. Only JPEGs skip the full-resolution
+    # decode (draft mode); other formats are decoded in full once, then reduced (see load_preview).
+    def get_preview(self, path, max_size):
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            full = self.entries.get((path, mtime))
+            if full is not None:
+                self.entries.move_to_end((path, mtime))
+                self.hits += 1
+                return full
+        with Image.open(path) as source:
+            size = fit_size(source.size, max_size)
+        key = (path, mtime, size)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        img = load_preview(path, size)
+        self.put(key, img)
+        return img
+
+    def put(self, key, img):
+        with self.lock:
+            # An older version of the same file can never be requested again
+            for stale in [k for k in self.entries if k[0] == key[0] and k[1] != key[1]]:
+                self.current_bytes -= self.image_bytes(self.entries.pop(stale))
+            if key in self.entries:
+                return
+            self.entries[key] = img
+            self.current_bytes += self.image_bytes(img)
+            # Evict least recently used images, but always keep the one just added
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= self.image_bytes(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.current_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+
+# Size of an image of `image_size` scaled down (never up) to fit within max_size, keeping its aspect ratio
+def fit_size(image_size, max_size):
+    width, height = image_size
+    scale = min(1.0, max_size[0] / width, max_size[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Decode a file at no less than `size`: JPEGs are decoded at 1/2, 1/4 or 1/8 scale by the DCT itself
+# (draft mode), which skips most of the decoding work and memory; other formats are decoded and then
+# reduced by a whole factor
+def load_preview(path, size):
+    with Image.open(path) as source:
+        source.draft("RGB", size)
+        img = source.convert("RGB")
+    factor = min(img.width // size[0], img.height // size[1])
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img
+
+
+# Shared by every ColorShift instance of the process
+image_cache = DecodedImageCache()
@@ -0,0 +1,154 @@
+# instrumentation.py
+# Structured timing and memory events for every operation, load and save, sent to a pluggable hook.
+# Off by default; switched on with set_hook(), a JSON-lines file, or the COLORSHIFT_EVENTS variable
+# (which worker processes of a batch inherit).
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+EVENTS_ENV = "COLORSHIFT_EVENTS"
+DEFAULT_EVENTS_PATH = os.path.join(os.path.expanduser("~"), ".colorshift", "events.jsonl")
+
+# Called with one event dict at a time, or None when instrumentation is off
+_hook = None
+
+
+class JsonLinesHook:
+    # Appends one JSON object per line; each event is a single write so processes can share a file
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+def set_hook(hook):
+    global _hook
+    _hook = hook
+
+
+def enabled():
+    return _hook is not None
+
+
+# Log events to a JSON-lines file, in this process and in the worker processes it starts
+def log_to_file(path=DEFAULT_EVENTS_PATH):
+    os.environ[EVENTS_ENV] = path
+    set_hook(JsonLinesHook(path))
+
+
+def disable():
+    os.environ.pop(EVENTS_ENV, None)
+    set_hook(None)
+
+
+def emit(event):
+    hook = _hook
+    if hook is None:
+        return
+    event.setdefault("time", time.time())
+    event.setdefault("pid", os.getpid())
+    try:
+        hook(event)
+    except Exception as e:
+        print(f"Instrumentation hook failed: {e}")
+
+
+# Peak resident memory since the last reset, from /proc on Linux (None elsewhere).
+# The peak is per process, so concurrent operations share it.
+def _status_bytes(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# Operations open on each thread; a nested operation resets the process peak, so it hands its own
+# peak up to the enclosing one
+_open = threading.local()
+
+
+# Time a block working on an image of `size` (width, height) and emit an "operation" event for it
+@contextmanager
+def operation(name, size=None, **fields):
+    if _hook is None:
+        yield
+        return
+    stack = _open.__dict__.setdefault("stack", [])
+    resettable = _reset_peak()
+    before = _status_bytes("VmRSS:")
+    frame = {"peak": 0}
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        peak = max(_status_bytes("VmHWM:"), frame["peak"]) if resettable else None
+        if stack and peak is not None:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        event = {"event": "operation", "operation": name, "seconds": seconds}
+        if size is not None:
+            megapixels = size[0] * size[1] / 1e6
+            event.update(width=size[0], height=size[1], megapixels=megapixels, mpix_per_s=megapixels / seconds if seconds else None)
+        event["peak_alloc_bytes"] = max(0, peak - before) if peak is not None and before is not None else None
+        event.update(fields)
+        emit(event)
+
+
+# Time a load or save and emit an "io" event with the file size.
+# Yields a dict whose entries are added to the event.
+@contextmanager
+def timed_io(kind, path, **fields):
+    if _hook is None:
+        yield {}
+        return
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        seconds = time.perf_counter() - start
+        try:
+            size = os.path.getsize(path)
+        except (OSError, TypeError):
+            size = None
+        emit({"event": "io", "kind": kind, "path": str(path), "seconds": seconds, "bytes": size, **fields})
+
+
+# Decorator for ColorShift methods: times the call on the size of self.img before it runs
+def instrumented(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _hook is None:
+            return method(self, *args, **kwargs)
+        img = getattr(self, "img", None)
+        with operation(method.__name__, img.size if img is not None else None):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+if os.environ.get(EVENTS_ENV):
+    set_hook(JsonLinesHook(os.environ[EVENTS_ENV]))
@@ -0,0 +1,217 @@
+# kernels.py
+# Whole-image array versions of the per-pixel ColorShift operations
+import os
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+import presets
+
+CHANNEL_INDEX = {'r': 0, 'g': 1, 'b': 2}
+
+# Rows are processed in bands of roughly this many pixels to bound the float temporaries
+CHUNK_PIXELS = 1 << 20
+
+# Integer kernel mode: blends, presets and change_color use fixed-point integer math with explicit
+# saturation instead of floats, so their output is bit-identical on every machine (float rounding
+# can change with FMA contraction and SIMD code paths). Set with set_integer_mode() or the
+# COLORSHIFT_INTEGER_KERNELS variable, which the worker processes of a batch inherit.
+INTEGER_ENV = "COLORSHIFT_INTEGER_KERNELS"
+INTEGER_MODE = os.environ.get(INTEGER_ENV, "") not in ("", "0")
+
+# Fractional bits of blend weights and of color matrix coefficients
+BLEND_SHIFT = 16
+MATRIX_SHIFT = 14
+
+
+def set_integer_mode(enabled):
+    global INTEGER_MODE
+    INTEGER_MODE = bool(enabled)
+    if INTEGER_MODE:
+        os.environ[INTEGER_ENV] = "1"
+    else:
+        os.environ.pop(INTEGER_ENV, None)
+
+
+def integer_mode():
+    return INTEGER_MODE
+
+
+# floor(x / 255) for 0 <= x <= 255 * 255, with shifts only (public: background.py blends with it too)
+def div255(x):
+    return (x + 1 + (x >> 8)) >> 8
+
+
+# Table of a per-channel blend a + weight * (b - a) against a flat value a, truncated and saturated
+# like Image.blend. Fixed point: the weight is rounded to BLEND_SHIFT fractional bits.
+def _blend_table(flat, weight):
+    fixed = int(round(weight * (1 << BLEND_SHIFT)))
+    return np.array([min(255, max(0, ((flat << BLEND_SHIFT) + fixed * (v - flat)) >> BLEND_SHIFT)) for v in range(256)], dtype=np.uint8)
+
+
+# Blend layer over rgb with the given weight (Image.blend with fixed-point math), as a new array
+def blend_fixed(rgb, layer, weight):
+    fixed = int(round(weight * (1 << BLEND_SHIFT)))
+    out = np.empty_like(rgb)
+    rows = max(1, CHUNK_PIXELS // max(1, rgb.shape[1]))
+    for top in range(0, len(rgb), rows):
+        a = rgb[top:top + rows].astype(np.int32)
+        acc = (a << BLEND_SHIFT) + fixed * (layer[top:top + rows].astype(np.int32) - a)
+        out[top:top + rows] = np.clip(acc >> BLEND_SHIFT, 0, 255)
+    return out
+
+
+# Split an image into a writable (height, width, 3) uint8 array and its alpha band (or None)
+def to_array(img):
+    alpha = img.getchannel("A") if img.mode == "RGBA" else None
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.array(img, dtype=np.uint8), alpha
+
+
+# Build an image back from an RGB array, re-attaching the alpha band if there was one
+def from_array(rgb, alpha=None):
+    img = Image.fromarray(np.ascontiguousarray(rgb, dtype=np.uint8))
+    if alpha is not None:
+        img.putalpha(alpha)
+    return img
+
+
+# Yield row bands of the array so that large images never need full-frame float copies
+def iter_bands(rgb):
+    height, width = rgb.shape[:2]
+    rows = max(1, CHUNK_PIXELS // max(1, width))
+    for top in range(0, height, rows):
+        yield rgb[top:top + rows]
+
+
+# Blend every pixel whose selected channel is dominant towards the target color (in place)
+def change_color(rgb, target_color, color_to_change):
+    index = CHANNEL_INDEX[color_to_change]
+    if INTEGER_MODE:
+        return _change_color_fixed(rgb, index, target_color)
+    target = np.asarray(target_color[:3], dtype=np.float64)
+    for band in iter_bands(rgb):
+        channel = band[..., index]
+        brightest = np.maximum(np.maximum(band[..., 0], band[..., 1]), band[..., 2])
+        # Non-dominant pixels get a zero factor, which leaves them exactly unchanged
+        factor = np.where(channel >= brightest, channel / 255.0, 0.0)
+        keep = 1 - factor
+        for i in range(3):
+            plane = keep * band[..., i]
+            plane += factor * target[i]
+            band[..., i] = np.clip(plane, 0, 255, out=plane)
+    return rgb
+
+
+# Integer change_color: the weight is channel / 255, so each plane is the exact
+# floor((value * (255 - channel) + target * channel) / 255), computed in uint16
+def _change_color_fixed(rgb, index, target_color):
+    target = [min(255, max(0, int(c))) for c in target_color[:3]]
+    for band in iter_bands(rgb):
+        channel = band[..., index]
+        brightest = np.maximum(np.maximum(band[..., 0], band[..., 1]), band[..., 2])
+        factor = np.where(channel >= brightest, channel, 0).astype(np.uint16)
+        keep = 255 - factor
+        for i in range(3):
+            band[..., i] = div255(band[..., i] * keep + factor * target[i])
+    return rgb
+
+
+# Map every pixel through a 3x4 affine color matrix (see presets.py), rounding and clamping
+# to 0-255 like Image.convert("RGB", matrix) (in place)
+def apply_color_matrix(rgb, matrix):
+    matrix = presets.to_matrix(matrix)
+    if INTEGER_MODE:
+        return _apply_color_matrix_fixed(rgb, matrix)
+    for band in iter_bands(rgb):
+        band[...] = np.array(Image.fromarray(np.ascontiguousarray(band)).convert("RGB", matrix))
+    return rgb
+
+
+# Integer color matrix: coefficients rounded to MATRIX_SHIFT fractional bits, products summed in
+# int32 (int64 for matrices too large for it), then a floor shift and saturation to 0-255
+def _apply_color_matrix_fixed(rgb, matrix):
+    coefficients = [[int(round(matrix[4 * i + j] * (1 << MATRIX_SHIFT))) for j in range(4)] for i in range(3)]
+    # The rounding half is folded into the offset
+    for row in coefficients:
+        row[3] += 1 << (MATRIX_SHIFT - 1)
+    largest = max(sum(abs(c) for c in row[:3]) * 255 + abs(row[3]) for row in coefficients)
+    dtype = np.int32 if largest < 2 ** 31 else np.int64
+    for band in iter_bands(rgb):
+        planes = [band[..., j].astype(dtype) for j in range(3)]
+        for i, (red, green, blue, offset) in enumerate(coefficients):
+            acc = planes[0] * red
+            acc += planes[1] * green
+            acc += planes[2] * blue
+            acc += offset
+            acc >>= MATRIX_SHIFT
+            band[..., i] = np.clip(acc, 0, 255, out=acc)
+    return rgb
+
+
+# Apply a built-in or registered color preset (in place)
+def apply_color_preset(rgb, preset):
+    return apply_color_matrix(rgb, presets.preset_matrix(preset))
+
+
+# Replace every pixel whose channels are all below the threshold with a flat color (in place)
+def replace_dark_pixels(rgb, color, threshold):
+    for band in iter_bands(rgb):
+        dark = (band[..., 0] < threshold) & (band[..., 1] < threshold) & (band[..., 2] < threshold)
+        band[dark] = color[:3]
+    return rgb
+
+
+# Recolor the near-black (< 30) background (in place)
+def change_black_background(rgb, new_bg_color):
+    return replace_dark_pixels(rgb, new_bg_color, 30)
+
+
+# Paint the dark (< 100) areas of the image with the mask color (in place)
+def apply_color_mask(rgb, mask_color):
+    return replace_dark_pixels(rgb, mask_color, 100)
+
+
+# Grayscale through Pillow's "L" conversion, spread back over the three channels (in place)
+def convert_to_black_and_white(rgb):
+    for band in iter_bands(rgb):
+        band[...] = np.array(Image.fromarray(np.ascontiguousarray(band)).convert("L"))[..., None]
+    return rgb
+
+
+# Scale the brightness exactly like ImageEnhance.Brightness (in place)
+def adjust_brightness(rgb, factor):
+    if INTEGER_MODE:
+        table = _blend_table(0, factor)
+        for band in iter_bands(rgb):
+            np.take(table, band, out=band)
+        return rgb
+    for band in iter_bands(rgb):
+        band[...] = np.array(ImageEnhance.Brightness(Image.fromarray(band)).enhance(factor))
+    return rgb
+
+
+# Mean gray level ImageEnhance.Contrast blends against, computed band by band
+def contrast_mean(rgb):
+    histogram = [0] * 256
+    for band in iter_bands(rgb):
+        for i, count in enumerate(Image.fromarray(np.ascontiguousarray(band)).convert("L").histogram()):
+            histogram[i] += count
+    total = 0
+    for i in range(256):
+        total += i * histogram[i]
+    return int(total / sum(histogram) + 0.5)
+
+
+# Blend against a flat gray of the given mean exactly like ImageEnhance.Contrast (in place)
+def adjust_contrast(rgb, factor, mean):
+    if INTEGER_MODE:
+        table = _blend_table(mean, factor)
+        for band in iter_bands(rgb):
+            np.take(table, band, out=band)
+        return rgb
+    for band in iter_bands(rgb):
+        degenerate = Image.new("RGB", (band.shape[1], band.shape[0]), (mean, mean, mean))
+        band[...] = np.array(Image.blend(degenerate, Image.fromarray(band), factor))
+    return rgb
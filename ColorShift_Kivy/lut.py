@@ -0,0 +1,157 @@
+# lut.py
+# Compile per-pixel color operations into 3D lookup tables and apply them in one pass
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import ImageFilter
+
+import kernels
+import presets
+
+# Exact tables hold one entry per 24-bit color; smaller sizes are lattices with trilinear interpolation
+EXACT = 256
+LATTICE_SIZES = (17, 33, 65)
+
+# An exact table takes about 117 MB (entries and their packed copy), so this holds two of them
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Pure functions of the (r, g, b) value of a pixel that can be compiled into a table
+OPERATIONS = {
+    "convert_to_black_and_white": kernels.convert_to_black_and_white,
+    "change_black_background": kernels.change_black_background,
+    "change_color": kernels.change_color,
+    "apply_color_mask": kernels.apply_color_mask,
+    "apply_color_preset": kernels.apply_color_preset,
+    "color_matrix": kernels.apply_color_matrix,
+    "brightness": kernels.adjust_brightness,
+    "contrast": kernels.adjust_contrast,
+}
+
+
+# Every color of the table as an (n, 1, 3) uint8 array, blue-major / red-minor like Color3DLUT
+def identity_grid(size):
+    if size == EXACT:
+        levels = np.arange(256, dtype=np.uint8)
+    else:
+        levels = np.round(np.linspace(0, 255, size)).astype(np.uint8)
+    b, g, r = np.meshgrid(levels, levels, levels, indexing="ij")
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)[:, None, :]
+
+
+class ColorLUT:
+    def __init__(self, table, size):
+        self.size = size
+        self.table = table
+        if size == EXACT:
+            # Pad each entry to 4 bytes so a lookup is a single uint32 gather
+            packed = np.zeros((len(table), 4), dtype=np.uint8)
+            packed[:, :3] = table
+            self.packed = packed.view(np.uint32)[:, 0]
+        else:
+            self.filter = ImageFilter.Color3DLUT(size, table.reshape(-1).astype(np.float32) / 255.0)
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes + (self.packed.nbytes if self.size == EXACT else 0)
+
+    # Map every pixel of an image through the table (the alpha band is left untouched)
+    def apply(self, img):
+        if self.size != EXACT:
+            alpha = img.getchannel("A") if img.mode == "RGBA" else None
+            return kernels.from_array(np.array(img.convert("RGB").filter(self.filter)), alpha)
+        rgb, alpha = kernels.to_array(img)
+        return kernels.from_array(self.apply_array(rgb), alpha)
+
+    # Map an RGB array through the table (in place)
+    def apply_array(self, rgb):
+        if self.size != EXACT:
+            rgb[...] = np.array(kernels.from_array(rgb).filter(self.filter))
+            return rgb
+        for band in kernels.iter_bands(rgb):
+            index = (band[..., 2].astype(np.uint32) << 16) | (band[..., 1].astype(np.uint32) << 8) | band[..., 0]
+            band[...] = np.take(self.packed, index).view(np.uint8).reshape(index.shape + (4,))[..., :3]
+        return rgb
+
+
+# Run an array operation over the identity grid to build its table
+def build_lut(function, params=(), size=EXACT):
+    if size != EXACT and not 2 <= size <= 65:
+        raise ValueError(f"LUT size must be {EXACT} (exact) or between 2 and 65, got {size}")
+    grid = identity_grid(size)
+    function(grid, *params)
+    return ColorLUT(grid[:, 0, :], size)
+
+
+class TableCache:
+    # Compiled tables keyed by what they were built from, bounded by total bytes with LRU eviction
+    # like prefix_cache.py
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> ColorLUT, least recently used first
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # The table of `key`, built by build() when it is not cached
+    def get(self, key, build):
+        with self.lock:
+            table = self.entries.get(key)
+            if table is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return table
+            self.misses += 1
+        table = build()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = table
+                self.current_bytes += table.nbytes
+            # Evict least recently used tables, but always keep the one just added
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+        return table
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.current_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+
+# Shared by compile_lut and compile_chain
+table_cache = TableCache()
+
+
+# Compiled tables are cached by operation name, parameters, size and kernel mode (see kernels.py)
+def compile_lut(operation, params=(), size=EXACT):
+    params = tuple(tuple(p) if isinstance(p, list) else p for p in params)
+    # Presets are cached by their matrix, so re-registering a name never serves a stale table
+    if operation == "apply_color_preset":
+        operation, params = "color_matrix", (presets.preset_matrix(params[0]),)
+    if operation not in OPERATIONS:
+        raise ValueError(f"Operation '{operation}' cannot be compiled into a LUT. Choose one from {sorted(OPERATIONS)}")
+    key = ("operation", operation, params, size, kernels.integer_mode())
+    return table_cache.get(key, lambda: build_lut(OPERATIONS[operation], params, size))
+
+
+# Apply a named per-pixel operation to an image through its (cached) table
+def apply_lut(img, operation, params=(), size=EXACT):
+    return compile_lut(operation, params, size).apply(img)
+
+
+# Compile an ordered chain of (operation, params) steps into a single table
+def compile_chain(steps, size=EXACT):
+    for operation, _ in steps:
+        if operation not in OPERATIONS:
+            raise ValueError(f"Operation '{operation}' cannot be compiled into a LUT. Choose one from {sorted(OPERATIONS)}")
+
+    def run_chain(grid):
+        for operation, params in steps:
+            OPERATIONS[operation](grid, *params)
+    return table_cache.get(("chain", steps, size, kernels.integer_mode()), lambda: build_lut(run_chain, (), size))
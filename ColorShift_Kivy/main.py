@@ -4,15 +4,150 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.image import Image
 from kivy.uix.label import Label
-from kivy.uix.filechooser import FileChooserIconView
+from kivy.uix.filechooser import FileChooserController, FileChooserIconLayout
 from kivy.uix.spinner import Spinner
 from kivy.uix.slider import Slider
 from kivy.uix.togglebutton import ToggleButton
+from kivy.uix.progressbar import ProgressBar
+from kivy.clock import Clock
+from kivy.graphics.texture import Texture
+from kivy.core.window import Window
+from kivy.lang import Builder
+from kivy.properties import BooleanProperty, StringProperty
 from color_shift import ColorShift
+from history import EditHistory
+from pipeline import Pipeline
+from prefix_cache import prefix_cache, source_key
+import encoders
+import filters
+import gradients
+import instrumentation
+import kernels
+import masks
+from image_cache import fit_size, image_cache
+import presets
+import streaming
+import thumbnails
+import threading
 import os
 
+# Spinner entry -> ColorShift method of the variable-radius filters (see filters.py)
+RADIUS_EFFECTS = {"gaussian blur": "apply_gaussian_blur", "box blur": "apply_box_blur", "unsharp mask": "apply_unsharp_mask"}
+
+# Kivy's icon entry with a thumbnail of the image in place of the generic file icon
+Builder.load_string('''
+<ThumbnailFileChooser>:
+    layout: layout
+    ThumbnailIconLayout:
+        id: layout
+        controller: root
+
+[ThumbnailIconEntry@Widget]:
+    locked: False
+    path: ctx.path
+    selected: self.path in ctx.controller().selection
+    size_hint: None, None
+
+    on_touch_down: self.collide_point(*args[1].pos) and ctx.controller().entry_touched(self, args[1])
+    on_touch_up: self.collide_point(*args[1].pos) and ctx.controller().entry_released(self, args[1])
+    size: '100dp', '100dp'
+
+    canvas:
+        Color:
+            rgba: 1, 1, 1, 1 if self.selected else 0
+        BorderImage:
+            border: 8, 8, 8, 8
+            pos: root.pos
+            size: root.size
+            source: 'atlas://data/images/defaulttheme/filechooser_selected'
+
+    ThumbnailImage:
+        size: '64dp', '64dp'
+        isdir: ctx.isdir
+        path: ctx.path
+        pos: root.x + dp(18), root.y + dp(34)
+    Label:
+        text: ctx.name
+        font_name: ctx.controller().font_name
+        text_size: (root.width, self.height)
+        halign: 'center'
+        shorten: True
+        size: '100dp', '16dp'
+        pos: root.x, root.y + dp(16)
+    Label:
+        text: '{}'.format(ctx.get_nice_size())
+        font_name: ctx.controller().font_name
+        font_size: '11sp'
+        color: .8, .8, .8, 1
+        size: '100dp', '16sp'
+        pos: root.pos
+        halign: 'center'
+''')
+
+
+class ThumbnailIconLayout(FileChooserIconLayout):
+    _ENTRY_TEMPLATE = 'ThumbnailIconEntry'
+
+
+# File chooser whose icons are thumbnails from the disk cache (see thumbnails.py); missing ones are
+# made in the background, the entries in view first
+class ThumbnailFileChooser(FileChooserController):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prioritize_trigger = Clock.create_trigger(self.prioritize_visible, 0.1)
+        self.layout.ids.scrollview.bind(scroll_y=self.prioritize_trigger, size=self.prioritize_trigger)
+        self.bind(path=self.on_folder_changed)
+
+    def on_folder_changed(self, instance, path):
+        App.get_running_app().thumbnail_loader.clear_pending()
+
+    def prioritize_visible(self, dt):
+        scrollview = self.layout.ids.scrollview
+        left, bottom = scrollview.to_window(*scrollview.pos)
+        right, top = left + scrollview.width, bottom + scrollview.height
+        visible = []
+        for entry in reversed(self.layout.ids.stacklayout.children):
+            x, y = entry.to_window(*entry.pos)
+            if x < right and x + entry.width > left and y < top and y + entry.height > bottom:
+                visible.append(entry.path)
+        App.get_running_app().thumbnail_loader.prioritize(visible)
+
+
+class ThumbnailImage(Image):
+    path = StringProperty("")
+    isdir = BooleanProperty(False)
+
+    def on_path(self, instance, path):
+        self.load_thumbnail()
+
+    def on_isdir(self, instance, isdir):
+        self.load_thumbnail()
+
+    def load_thumbnail(self):
+        path = self.path
+        self.source = 'atlas://data/images/defaulttheme/filechooser_%s' % ('folder' if self.isdir else 'file')
+        if self.isdir or not path.lower().endswith(('.png', '.jpg', '.jpeg')):
+            return
+        thumbnail = App.get_running_app().thumbnail_loader.request(path, self.thumbnail_ready)
+        if thumbnail:
+            self.source = thumbnail
+
+    # Called on a worker thread; widgets are only touched on the UI thread
+    def thumbnail_ready(self, path, thumbnail):
+        if thumbnail:
+            Clock.schedule_once(lambda dt: self.show_thumbnail(path, thumbnail))
+
+    def show_thumbnail(self, path, thumbnail):
+        # The entry may have been reused for another file in the meantime
+        if path == self.path:
+            self.source = thumbnail
+
+
 class ColorShiftApp(App):
     def build(self):
+        # Thumbnails of the file chooser, cached on disk across sessions
+        self.thumbnail_loader = thumbnails.ThumbnailLoader(thumbnails.ThumbnailCache())
+
         # Main layout: Divide into two vertical sections
         self.main_layout = BoxLayout(orientation='horizontal', spacing=10)
         
@@ -44,6 +179,17 @@ class ColorShiftApp(App):
         self.effect_spinner.bind(text=self.on_effect_selected)
         self.static_left_layout.add_widget(self.effect_spinner)
 
+        # Timing and memory events of every operation, written as JSON lines (see instrumentation.py)
+        self.instrumentation_toggle = ToggleButton(text="Log timings", size_hint=(1, 0.1), state="down" if instrumentation.enabled() else "normal")
+        self.instrumentation_toggle.bind(state=self.toggle_instrumentation)
+        self.static_left_layout.add_widget(self.instrumentation_toggle)
+
+        # Encoder profile of saved images (see encoders.py)
+        self.output_profile = encoders.DEFAULT_PROFILE
+        self.profile_spinner = Spinner(text=self.output_profile, values=encoders.profile_names(), size_hint=(1, 0.1))
+        self.profile_spinner.bind(text=self.on_profile_selected)
+        self.static_left_layout.add_widget(self.profile_spinner)
+
         # Add info message
         self.instruction_label = Label(text="Choose an image to proceed with modification", size_hint=(1, 0.3))
         self.dynamic_left_layout.add_widget(self.instruction_label)
@@ -54,7 +200,7 @@ class ColorShiftApp(App):
         
         # Right section: Initially file chooser, then image display
         self.right_layout = BoxLayout(orientation='vertical', size_hint=(2/3, 1))
-        self.file_chooser = FileChooserIconView(filters=['*.png', '*.jpg', '*.jpeg'])
+        self.file_chooser = ThumbnailFileChooser(filters=['*.png', '*.jpg', '*.jpeg'])
         self.file_chooser.bind(selection=self.initial_image_selection)  # Initially bind for first image
         self.right_layout.add_widget(self.file_chooser)
         
@@ -66,6 +212,26 @@ class ColorShiftApp(App):
         self.current_image = None
         self.stored_original_image = None
         self.stored_modified_image = None
+
+        # Background render state: only the job with the latest id may update the UI
+        self.render_job_id = 0
+        self.render_cancel_event = None
+        self.progress_layout = BoxLayout(orientation='horizontal', size_hint=(1, 0.08), spacing=10)
+        self.progress_bar = ProgressBar(max=1, value=0, size_hint=(0.75, 1))
+        self.progress_layout.add_widget(self.progress_bar)
+        self.progress_layout.add_widget(Button(text="Cancel", size_hint=(0.25, 1), on_press=self.cancel_render_button))
+
+        # Undo/redo of the stacked edits (see history.py), shown with the Save and Cancel buttons
+        self.history = EditHistory()
+        self.history_layout = BoxLayout(orientation='horizontal', size_hint=(1, 0.1), spacing=10)
+        self.undo_btn = Button(text="Undo", on_press=self.undo_edit)
+        self.redo_btn = Button(text="Redo", on_press=self.redo_edit)
+        self.history_layout.add_widget(self.undo_btn)
+        self.history_layout.add_widget(self.redo_btn)
+
+        # Slider previews are debounced to at most one proxy render per 20 ms
+        self.live_step = None
+        self.live_preview_trigger = Clock.create_trigger(self.render_live_preview, 0.02)
         
         return self.main_layout
 
@@ -76,10 +242,11 @@ class ColorShiftApp(App):
             self.stored_original_image = self.current_image
 
             if self.current_image.lower().endswith(('.png', '.jpg', '.jpeg')):
+                self.load_source_image()
+
                 # Display the selected image
                 self.right_layout.clear_widgets()
-                self.img_widget = Image(source=self.current_image)
-                self.right_layout.add_widget(self.img_widget)
+                self.show_source_image()
                 
                 # Remove file chooser
                 self.right_layout.remove_widget(self.file_chooser)
@@ -162,11 +329,20 @@ class ColorShiftApp(App):
             self.sharpen_blur_layout = BoxLayout(size_hint = (1, 0.1))
             self.sharpen_blur_spinner = Spinner(
                 text="Select effect",
-                values=("sharpen", "blur"),
+                values=("sharpen", "blur", *RADIUS_EFFECTS),
                 size_hint=(1, 0.1)
             )
             self.sharpen_blur_layout.add_widget(self.sharpen_blur_spinner)
             self.dynamic_left_layout.add_widget(self.sharpen_blur_layout)
+
+            # Radius of the Gaussian blur, box blur and unsharp mask, in pixels of the full-size image
+            self.radius_layout = BoxLayout(orientation = "vertical", size_hint = (1, 0.2))
+            self.radius_slider = Slider(min=0.5, max=100, value=2, step=0.5, size_hint=(1, 0.1))
+            self.radius_label = Label(text=f"Radius: {self.radius_slider.value}")
+            self.radius_slider.bind(value=lambda instance, value: self.update_slider_label(self.radius_label, "Radius", value, "float"))
+            self.radius_layout.add_widget(self.radius_label)
+            self.radius_layout.add_widget(self.radius_slider)
+            self.dynamic_left_layout.add_widget(self.radius_layout)
             self.dynamic_left_layout.add_widget(BoxLayout())
 
             # Add button to apply sharpen or blur effect
@@ -178,7 +354,7 @@ class ColorShiftApp(App):
             self.preset_layout = BoxLayout(size_hint = (1, 0.1))
             self.preset_spinner = Spinner(
                 text="Select preset",
-                values=("warm", "cool", "vintage", "sepia"),
+                values=presets.preset_names(),
                 size_hint=(1, 0.1)
             )
             self.preset_layout.add_widget(self.preset_spinner)
@@ -249,6 +425,21 @@ class ColorShiftApp(App):
             self.colors_layout.add_widget(self.color2_layout)
             self.dynamic_left_layout.add_widget(self.colors_layout)
 
+            # Shape and strength of the gradient
+            self.gradient_options_layout = BoxLayout(orientation = "vertical", size_hint = (1, 0.3))
+            self.gradient_shape_spinner = Spinner(
+                text="vertical",
+                values=gradients.GRADIENT_SHAPES,
+                size_hint=(1, 0.1)
+            )
+            self.gradient_alpha_slider = Slider(min=0, max=1.0, value=gradients.DEFAULT_ALPHA, step=0.05, size_hint=(1, 0.1))
+            self.gradient_alpha_label = Label(text=f"Strength: {float(self.gradient_alpha_slider.value)}")
+            self.gradient_alpha_slider.bind(value=lambda instance, value: self.update_slider_label(self.gradient_alpha_label, "Strength", round(value, 2), "float"))
+            self.gradient_options_layout.add_widget(self.gradient_shape_spinner)
+            self.gradient_options_layout.add_widget(self.gradient_alpha_label)
+            self.gradient_options_layout.add_widget(self.gradient_alpha_slider)
+            self.dynamic_left_layout.add_widget(self.gradient_options_layout)
+
             # Add button to apply the gradient effect
             apply_gradient_btn = Button(text="Apply Gradient", size_hint=(1, 0.1), on_press=self.start_gradient_transformation)
             self.dynamic_left_layout.add_widget(apply_gradient_btn)
@@ -322,10 +513,51 @@ class ColorShiftApp(App):
             self.color_layout.add_widget(self.b_slider)
 
             self.dynamic_left_layout.add_widget(self.color_layout)
-            self.dynamic_left_layout.add_widget(BoxLayout(size_hint = (1, 0.1)))
+
+            # Which pixels the mask covers (see masks.py); the mask is cached, so moving the color sliders only recomposites
+            self.mask_options_layout = BoxLayout(orientation = "vertical", size_hint = (1, 0.2))
+            self.mask_criterion_spinner = Spinner(text=masks.COLOR_MASK[0], values=("dark", "luminance", "border"), size_hint=(1, 0.1))
+            self.mask_threshold_slider = Slider(min=0, max=255, value=masks.COLOR_MASK[1], step=1, size_hint=(1, 0.1))
+            self.mask_threshold_label = Label(text=f"Threshold: {int(self.mask_threshold_slider.value)}")
+            self.mask_threshold_slider.bind(value=lambda instance, value: self.update_slider_label(self.mask_threshold_label, "Threshold", value))
+            self.mask_options_layout.add_widget(self.mask_criterion_spinner)
+            self.mask_options_layout.add_widget(self.mask_threshold_label)
+            self.mask_options_layout.add_widget(self.mask_threshold_slider)
+            self.dynamic_left_layout.add_widget(self.mask_options_layout)
 
             apply_mask_btn = Button(text = "Apply Color Mask", size_hint=(1, 0.1), on_press = self.start_color_mask_transformation)
             self.dynamic_left_layout.add_widget(apply_mask_btn)
+            export_mask_btn = Button(text = "Export Mask", size_hint=(1, 0.1), on_press = self.start_mask_export)
+            self.dynamic_left_layout.add_widget(export_mask_btn)
+
+        # Slider panels preview live on the proxy image while their sliders (or toggles and spinners) move
+        self.live_step = {
+            "Change Color": self.color_change_step,
+            "Apply Gradient": self.gradient_step,
+            "Adjust Contrast or Brightness": self.contrast_brightness_step,
+            "Apply Transparency": self.transparency_step,
+            "Apply Color Mask": self.color_mask_step,
+            "Sharpen or Blur": self.sharpen_blur_step,
+        }.get(text)
+        if self.live_step:
+            for widget in self.dynamic_left_layout.walk(restrict=True):
+                if isinstance(widget, Slider):
+                    widget.bind(value=self.schedule_live_preview)
+                elif isinstance(widget, ToggleButton):
+                    widget.bind(state=self.schedule_live_preview)
+                elif isinstance(widget, Spinner):
+                    widget.bind(text=self.schedule_live_preview)
+
+    def toggle_instrumentation(self, instance, state):
+        if state == "down":
+            instrumentation.log_to_file()
+            print(f"Logging timings to {instrumentation.DEFAULT_EVENTS_PATH}")
+        else:
+            instrumentation.disable()
+            print("Timing log stopped.")
+
+    def on_profile_selected(self, spinner, text):
+        self.output_profile = text
 
     # Add save and cancel buttons after applying effect
     def add_save_cancel_buttons(self, modification_type="bw"):
@@ -336,8 +568,10 @@ class ColorShiftApp(App):
                 # Buttons are already displayed, so do nothing
                 return
             
+        self.right_layout.add_widget(self.history_layout)
+
         self.save_btn = Button(text="Save", size_hint=(1, 0.1))
-        self.save_btn.bind(on_press=lambda x: self.save_image(x, modification_type))
+        self.save_btn.bind(on_press=lambda x: self.save_image(x, self.modification_type))
         self.right_layout.add_widget(self.save_btn)
 
         self.cancel_mod_btn = Button(text="Cancel", size_hint=(1, 0.1))
@@ -360,7 +594,7 @@ class ColorShiftApp(App):
 
         # Reopen the FileChooser to let the user choose a new image
         self.right_layout.clear_widgets()
-        self.file_chooser = FileChooserIconView(filters=['*.png', '*.jpg', '*.jpeg'])
+        self.file_chooser = ThumbnailFileChooser(filters=['*.png', '*.jpg', '*.jpeg'])
         self.file_chooser.bind(selection=self.show_image)
         self.right_layout.add_widget(self.file_chooser)
 
@@ -374,10 +608,11 @@ class ColorShiftApp(App):
 
             # Ensure the selected file is an image
             if self.current_image.lower().endswith(('.png', '.jpg', '.jpeg')):
+                self.load_source_image()
+
                 # Display the new selected image
                 self.right_layout.clear_widgets()
-                self.img_widget = Image(source=self.current_image)
-                self.right_layout.add_widget(self.img_widget)
+                self.show_source_image()
                 
                 # Once image is shown, remove the "Cancel" button and re-add the "Choose Another Photo" button
                 self.static_left_layout.remove_widget(self.cancel_btn)
@@ -388,67 +623,230 @@ class ColorShiftApp(App):
 
     def cancel_selection(self, instance):
         # Re-display the stored image (initial image) when the user clicks on "Cancel"
-        if hasattr(self, 'stored_modified_image') and self.stored_modified_image:
-            self.img_widget = Image(source=self.stored_modified_image)
+        if hasattr(self, 'stored_modified_image') and self.stored_modified_image is not None:
+            self.img_widget = Image()
+            self.show_pil_image(self.stored_modified_image)
             self.right_layout.add_widget(self.img_widget)
 
             # Add Save and Cancel buttons
             self.add_save_cancel_buttons(self.modification_type)
 
-        elif hasattr(self, 'stored_original_image') and self.stored_original_image and not self.stored_modified_image:
+        elif hasattr(self, 'stored_original_image') and self.stored_original_image and self.stored_modified_image is None:
             self.right_layout.clear_widgets()
-            self.img_widget = Image(source=self.stored_original_image)
-            self.right_layout.add_widget(self.img_widget)
+            self.show_source_image()
 
         # Remove "Cancel" button and re-add "Choose Another Photo" button
         self.static_left_layout.remove_widget(self.cancel_btn)
         self.static_left_layout.add_widget(self.choose_another_btn)
     
-    # Save the modified image over the original and remove the temporary file
+    # Render the stacked edits at full resolution (the only full-size render) and encode it once
     def save_image(self, instance, modification_type="bw"):
-        if self.stored_modified_image and self.current_image:
-            # Save the modified image with a new name (append the modification type to the original file name)
-            original_dir, original_filename = os.path.split(self.current_image)
-            filename_wo_ext, ext = os.path.splitext(original_filename)
-            bw_img_filename = f"{filename_wo_ext}_{modification_type}{ext}"  # E.g., "image_bw.png"
-            bw_img_path = os.path.join(original_dir, bw_img_filename)
-            img_to_save = PILImage.open(self.stored_modified_image)
-            img_to_save.save(bw_img_path)
-            os.remove(self.stored_modified_image)  # Remove the temporary file
-            self.stored_modified_image = None
+        if self.stored_modified_image is not None and self.current_image:
+            self.start_render(lambda result: self.write_full_resolution(result, modification_type))
+
+    def write_full_resolution(self, result, modification_type):
+        # Save the modified image with a new name (append the modification type to the original file name)
+        original_dir, original_filename = os.path.split(self.current_image)
+        filename_wo_ext, ext = os.path.splitext(original_filename)
+        bw_img_filename = f"{filename_wo_ext}_{modification_type}{ext}"  # E.g., "image_bw.png"
+        bw_img_path = os.path.join(original_dir, bw_img_filename)
+        encoders.save_image(result, bw_img_path, self.output_profile)
+        self.stored_modified_image = None
+        self.reset_edits()
 
-            # Remove Save and Cancel buttons
-            self.right_layout.remove_widget(self.save_btn)
-            self.right_layout.remove_widget(self.cancel_mod_btn)
+        # Remove Save and Cancel buttons
+        self.right_layout.remove_widget(self.history_layout)
+        self.right_layout.remove_widget(self.save_btn)
+        self.right_layout.remove_widget(self.cancel_mod_btn)
 
     # Cancel the modification and revert to the original image
     def cancel_image_modification(self, instance):
-        if self.stored_modified_image:
+        if self.stored_modified_image is not None:
 
-            # Restore the original image
-            self.img_widget.source = self.stored_original_image
-            self.img_widget.reload()
+            # Restore the original image from the decoded pixels
+            self.show_pil_image(self.proxy_img)
 
             # Remove Save and Cancel buttons
+            self.right_layout.remove_widget(self.history_layout)
             self.right_layout.remove_widget(self.save_btn)
             self.right_layout.remove_widget(self.cancel_mod_btn)
 
-            os.remove(self.stored_modified_image)  # Delete the temporary black-and-white image
             self.stored_modified_image = None
-
-    def process_and_update_image(self, effect_name, ColorShiftInstance):
-        # Save the modified image temporarily and display it
-        modified_img_path = os.path.join(os.getcwd(), "ColorShift_Kivy/images", f"{effect_name}_image.png")
-        ColorShiftInstance.save_image(modified_img_path)
-        self.stored_modified_image = modified_img_path
-
-        # Update the Kivy UI with the modified image
-        self.img_widget.source = modified_img_path
-        self.img_widget.reload()  # Reload the image to reflect changes
+            self.reset_edits()
+
+    # Decode only a window-sized preview of the selected image (JPEGs in draft mode, see image_cache.py);
+    # the full-resolution pixels are decoded on the worker thread by the final render
+    def load_source_image(self):
+        self.cancel_render()
+        with instrumentation.timed_io("load", self.current_image, preview=True):
+            preview = image_cache.get_preview(self.current_image, Window.size)
+        with PILImage.open(self.current_image) as source:
+            self.source_size = source.size
+        self.proxy_img = self.make_proxy(preview)
+        self.reset_edits()
+
+    # Show the unedited preview in a new image widget
+    def show_source_image(self):
+        self.img_widget = Image()
+        self.show_pil_image(self.proxy_img)
+        self.right_layout.add_widget(self.img_widget)
+
+    def reset_edits(self):
+        self.history.reset(self.proxy_img)
+        self.proxy_base = self.proxy_img
+
+    # Downscaled copy of the source, never larger than the window, used for every on-screen preview
+    def make_proxy(self, img):
+        size = fit_size(img.size, Window.size)
+        if size == img.size:
+            return img
+        return img.resize(size, PILImage.BILINEAR, reducing_gap=2.0)
+
+    # Stack a new effect on top of the previous ones and preview it on the proxy;
+    # the full-resolution render waits until Save
+    def apply_effect(self, effect_name, step):
+        self.proxy_base = self.render_proxy(self.history.steps + [step])
+        self.history.push(step, effect_name, self.proxy_base)
+        self.process_and_update_image("_".join(self.history.names), self.proxy_base)
+
+    # Step back or forward through the edit history; only the preview is restored, the
+    # full-resolution render still waits until Save
+    def undo_edit(self, instance):
+        self.cancel_render()
+        self.proxy_base = self.history.undo()
+        self.show_history_state()
+
+    def redo_edit(self, instance):
+        self.cancel_render()
+        self.proxy_base = self.history.redo()
+        self.show_history_state()
+
+    def show_history_state(self):
+        self.stored_modified_image = self.proxy_base
+        self.show_pil_image(self.proxy_base)
+        self.modification_type = "_".join(self.history.names) or "original"
+        self.update_history_buttons()
+
+    def update_history_buttons(self):
+        self.undo_btn.disabled = not self.history.can_undo()
+        self.redo_btn.disabled = not self.history.can_redo()
+
+    # Slider values changed: re-render the proxy preview on the next trigger
+    def schedule_live_preview(self, *args):
+        self.live_preview_trigger()
+
+    # Preview the panel's current slider values on top of the applied edits, without committing them
+    def render_live_preview(self, dt):
+        if not self.live_step or not self.current_image or not hasattr(self, 'proxy_base'):
+            return
+        step = self.live_step()
+        if step is not None:
+            self.show_pil_image(self.render_proxy(self.history.steps + [step]))
+
+    # Filter radii are in pixels of the full-size image, so they shrink with the proxy in previews
+    def proxy_step(self, step):
+        if step[0] in filters.OPERATIONS:
+            scale = self.proxy_img.width / self.source_size[0]
+            return (step[0], step[1] * scale) + tuple(step[2:])
+        return step
+
+    # Preview of a chain of steps on the proxy, rendered the way Save renders the full-size image: the
+    # same fused runs and split points, from the deepest cached prefix (see prefix_cache.py), so the
+    # saved file shows what the preview showed
+    def render_proxy(self, steps):
+        key = ("proxy", source_key(None, self.current_image), self.proxy_img.size)
+        return prefix_cache.render(key, self.proxy_img, [self.proxy_step(step) for step in steps], self.run_proxy_segment)
+
+    # Masks computed on the proxy are keyed by its pixels, so they are reused while only the mask
+    # color changes (see masks.py)
+    @staticmethod
+    def run_proxy_segment(img, segment, progress=None):
+        key = source_key(img) if any(step[0] == "apply_mask" for step in segment) else None
+        return Pipeline(segment).run(img, key=key)
+
+    # Render the stacked edits at full resolution on a worker thread, then hand the result to on_done
+    def start_render(self, on_done):
+        self.start_job(self.render_worker, self.current_image, self.history.steps, on_done)
+
+    # Run target(job_id, *args, cancel_event) on a worker thread with the progress bar shown; a newer
+    # job replaces any job still running
+    def start_job(self, target, *args):
+        self.cancel_render()
+        job_id = self.render_job_id
+        self.render_cancel_event = threading.Event()
+        self.progress_bar.value = 0
+        if self.progress_layout not in self.right_layout.children:
+            self.right_layout.add_widget(self.progress_layout)
+        worker = threading.Thread(target=target, args=(job_id, *args, self.render_cancel_event), daemon=True)
+        worker.start()
+
+    # Full-resolution render of steps over the decoded source, from the deepest cached prefix of the
+    # steps so saving again after changing a late step does not re-run the early ones (see prefix_cache.py)
+    def render_steps(self, color_shift, image_path, steps, report_progress, cancel_event):
+        def run_segment(img, segment, progress):
+            return streaming.render_image(img, segment, progress=progress, cancel_event=cancel_event)
+        return prefix_cache.render(source_key(color_shift.img, image_path), color_shift.img, steps, run_segment, report_progress)
+
+    # Runs on the worker thread; everything that touches widgets goes through Clock.schedule_once
+    def render_worker(self, job_id, image_path, steps, on_done, cancel_event):
+        def report_progress(fraction):
+            Clock.schedule_once(lambda dt: self.update_render_progress(job_id, fraction))
+        color_shift = None
+        try:
+            # The only full-resolution decode (cached, so saving again does not decode again)
+            color_shift = ColorShift(image_path)
+            result = self.render_steps(color_shift, image_path, steps, report_progress, cancel_event)
+        except streaming.RenderCancelled:
+            return
+        except Exception as e:
+            print(f"Error occurred while processing the image: {e}")
+            result = None
+        Clock.schedule_once(lambda dt: self.finish_render(job_id, color_shift, result, on_done))
+
+    def update_render_progress(self, job_id, fraction):
+        if job_id == self.render_job_id:
+            self.progress_bar.value = fraction
+
+    # Deliver the finished render, unless the job was cancelled or replaced in the meantime
+    def finish_render(self, job_id, color_shift, result, on_done):
+        if job_id != self.render_job_id:
+            return
+        self.right_layout.remove_widget(self.progress_layout)
+        if result is not None:
+            self.color_shift = color_shift
+            self.color_shift.img = result
+            on_done(result)
+
+    # Stop the running job (if any) and make sure its result is never shown
+    def cancel_render(self):
+        if self.render_cancel_event:
+            self.render_cancel_event.set()
+        self.render_job_id += 1
+        self.right_layout.remove_widget(self.progress_layout)
+
+    # Cancel button next to the progress bar; the applied edits stay in place
+    def cancel_render_button(self, instance):
+        self.cancel_render()
+
+    # Upload a PIL image straight into the image widget's texture (no temporary file)
+    def show_pil_image(self, pil_img):
+        if pil_img.mode not in ("RGB", "RGBA"):
+            pil_img = pil_img.convert("RGB")
+        colorfmt = pil_img.mode.lower()
+        texture = Texture.create(size=pil_img.size, colorfmt=colorfmt)
+        texture.blit_buffer(pil_img.tobytes(), colorfmt=colorfmt, bufferfmt='ubyte')
+        texture.flip_vertical()  # PIL rows run top-down, OpenGL rows bottom-up
+        self.img_widget.texture = texture
+
+    def process_and_update_image(self, effect_name, preview_img):
+        # Keep the preview in memory and display it
+        self.stored_modified_image = preview_img
+        self.show_pil_image(self.stored_modified_image)
 
         # Add Save and Cancel buttons
         self.modification_type = effect_name
         self.add_save_cancel_buttons(effect_name)
+        self.update_history_buttons()
 
 
     # Update the label for RGB slider
@@ -465,92 +863,128 @@ class ColorShiftApp(App):
 
     def start_black_and_white_transformation(self, instance):
         if self.current_image:
-            ColorShiftInstance = ColorShift(self.current_image)
-            bw_img = ColorShiftInstance.convert_to_black_and_white()
-            if bw_img:
-                # Path for temporary black and white image
-                bw_img_path = os.path.join(os.getcwd(), "ColorShift_Kivy/images", "bw_image.png")
-                ColorShiftInstance.save_image(bw_img_path)
-                self.stored_modified_image = bw_img_path
-
-                # Update the Kivy UI with the black-and-white image
-                self.img_widget.source = bw_img_path
-                self.img_widget.reload()  # Reload the image to reflect changes
-
-                # Add Save and Cancel buttons
-                self.modification_type = "bw"
-                self.add_save_cancel_buttons()
+            self.apply_effect("bw", ("convert_to_black_and_white",))
 
     def start_sharpen_blur_transformation(self, instance):
-        selected_effect = self.sharpen_blur_spinner.text  # Get the selected effect from the dropdown
-        if self.current_image and selected_effect in ("sharpen", "blur"):
+        step = self.sharpen_blur_step()
+        if self.current_image and step:
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.apply_sharpen_blur(selected_effect)
-            self.process_and_update_image(selected_effect, ColorShiftInstance)
+            self.apply_effect(self.sharpen_blur_spinner.text.replace(" ", "_"), step)
         else:
             print("Please select an effect and an image.")
 
     def start_preset_transformation(self, instance):
         selected_preset = self.preset_spinner.text
-        if self.current_image and selected_preset in ("warm", "cool", "vintage", "sepia"):
+        if self.current_image and selected_preset in presets.preset_names():
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.apply_color_preset(selected_preset)
-            self.process_and_update_image(selected_preset, ColorShiftInstance)
+            self.apply_effect(selected_preset, ("apply_color_preset", selected_preset))
         else:
             print("Please select a preset.")
 
-    # Function to get RGB values from sliders and apply gradient
-    def start_gradient_transformation(self, instance):
+    # Steps built from the current values of each slider panel (shared by Apply and the live preview)
+    def gradient_step(self):
         color1 = (int(self.r1_slider.value), int(self.g1_slider.value), int(self.b1_slider.value))
         color2 = (int(self.r2_slider.value), int(self.g2_slider.value), int(self.b2_slider.value))
-        if color1 and color2 and self.current_image:
+        return ("apply_gradient", color1, color2, self.gradient_shape_spinner.text, float(self.gradient_alpha_slider.value))
+
+    def contrast_brightness_step(self):
+        return ("adjust_contrast_brightness", float(self.contrast_slider.value), float(self.brightness_slider.value))
+
+    def transparency_step(self):
+        return ("apply_transparency", int(self.transparency_slider.value))
+
+    def mask_criterion(self):
+        return (self.mask_criterion_spinner.text, int(self.mask_threshold_slider.value))
+
+    def color_mask_step(self):
+        return ("apply_mask", (int(self.r_slider.value), int(self.g_slider.value), int(self.b_slider.value)), self.mask_criterion())
+
+    def sharpen_blur_step(self):
+        selected_effect = self.sharpen_blur_spinner.text  # Get the selected effect from the dropdown
+        if selected_effect in ("sharpen", "blur"):
+            return ("apply_sharpen_blur", selected_effect)
+        if selected_effect in RADIUS_EFFECTS:
+            return (RADIUS_EFFECTS[selected_effect], float(self.radius_slider.value))
+        return None
+
+    def color_change_step(self):
+        target_color = (int(self.target_r_slider.value), int(self.target_g_slider.value), int(self.target_b_slider.value))
+        for toggle, color_to_change in ((self.toggle_r, "r"), (self.toggle_g, "g"), (self.toggle_b, "b")):
+            if toggle.state == "down":
+                return ("change_color", target_color, color_to_change)
+        return None
+
+    # Function to get RGB values from sliders and apply gradient
+    def start_gradient_transformation(self, instance):
+        if self.current_image:
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.apply_gradient(color1, color2)
-            self.process_and_update_image("gradient", ColorShiftInstance)
+            self.apply_effect("gradient", self.gradient_step())
 
     def start_contrast_brightness_transformation(self, instance):
-        contrast = float(self.contrast_slider.value)
-        brightness = float(self.brightness_slider.value)
-        if contrast and brightness and self.current_image:
+        step = self.contrast_brightness_step()
+        if step[1] and step[2] and self.current_image:
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.adjust_contrast_brightness(contrast, brightness)
-            self.process_and_update_image("contrast_brightness", ColorShiftInstance)
+            self.apply_effect("contrast_brightness", step)
         else:
             print("Please select a valid image or a valid contrast / brightness factor.")
     
     def start_transparency_transformation(self, instance):
-        transparency_factor = int(self.transparency_slider.value)
-        if transparency_factor and self.current_image:
+        step = self.transparency_step()
+        if step[1] and self.current_image:
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.apply_transparency(transparency_factor)
-            self.process_and_update_image("transparent", ColorShiftInstance)
+            self.apply_effect("transparent", step)
     
     def start_color_mask_transformation(self, instance):
-        color = (int(self.r_slider.value), int(self.g_slider.value), int(self.b_slider.value))
-        if color and self.current_image:
+        if self.current_image:
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.apply_color_mask(color)
-            self.process_and_update_image("color_mask", ColorShiftInstance)
+            self.apply_effect("color_mask", self.color_mask_step())
+
+    # Save the full-resolution mask of the edited image next to it, for "--effect mask" on a batch
+    def start_mask_export(self, instance):
+        if not self.current_image:
+            return
+        # Painting a mask hides the pixels it was taken from, so the mask comes from the image as it
+        # was before the last applied mask step
+        steps = self.history.steps
+        mask_steps = [index for index, step in enumerate(steps) if step[0] == "apply_mask"]
+        if mask_steps:
+            steps = steps[:mask_steps[-1]]
+        self.start_job(self.mask_worker, self.current_image, steps, self.mask_criterion())
+
+    # Runs on the worker thread: render the steps (none when the mask is taken from the source), then
+    # compute the mask through mask_cache and save it next to the image
+    def mask_worker(self, job_id, image_path, steps, criterion, cancel_event):
+        def report_progress(fraction):
+            Clock.schedule_once(lambda dt: self.update_render_progress(job_id, fraction))
+        try:
+            color_shift = ColorShift(image_path)
+            img = self.render_steps(color_shift, image_path, steps, report_progress, cancel_event)
+            image_key = (source_key(color_shift.img, image_path), kernels.integer_mode(), tuple(steps))
+            mask = masks.mask_cache.mask_for(image_key, masks.normalize(criterion), img)
+            base, _ = os.path.splitext(image_path)
+            mask_path = f"{base}{masks.MASK_SUFFIX}.png"
+            masks.save_mask(mask, mask_path)
+            print(f"Mask saved at {mask_path}")
+        except streaming.RenderCancelled:
+            return
+        except Exception as e:
+            print(f"Error occurred while exporting the mask: {e}")
+        Clock.schedule_once(lambda dt: self.finish_job(job_id))
+
+    # Hide the progress bar of a finished job, unless a newer job has taken it over
+    def finish_job(self, job_id):
+        if job_id == self.render_job_id:
+            self.right_layout.remove_widget(self.progress_layout)
 
     def start_color_change_transformation(self, instance):
-        target_color = (int(self.target_r_slider.value), int(self.target_g_slider.value), int(self.target_b_slider.value))
-        if self.toggle_r.state == "down":
-            color_to_change = "r"
-        elif self.toggle_g.state == "down":
-            color_to_change = "g"
-        elif self.toggle_b.state == "down":
-            color_to_change = "b"
-        if self.current_image and color_to_change and target_color:
+        step = self.color_change_step()
+        if self.current_image and step:
             self.stored_original_image = self.current_image
-            ColorShiftInstance = ColorShift(self.current_image)
-            ColorShiftInstance.change_color(target_color, color_to_change)
-            self.process_and_update_image("modified", ColorShiftInstance)
+            self.apply_effect("modified", step)
+
+    # Remove the history snapshots spilled to disk
+    def on_stop(self):
+        self.history.close()
 
 # Run the app
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+# manifest.py
+# Remember which inputs were already processed with which effect chain, so batch runs only
+# redo files whose content or chain changed
+import hashlib
+import json
+import os
+
+from pipeline import ENGINE_VERSION, simplify
+
+MANIFEST_NAME = ".colorshift-manifest.json"
+MANIFEST_VERSION = 1
+
+
+# SHA-256 of a file's content
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Entries of a chain that are run settings (added by batch.py), not effects
+CHAIN_SETTINGS = ("output_profile", "integer_kernels", "mask_file")
+
+
+# Stable identifier of an effect chain and its parameters. The effects are keyed as the pipeline
+# runs them (see pipeline.simplify): presets as their matrices, defaults filled in. So editing a
+# preset's matrix changes the key, and so does a new engine version.
+def chain_key(steps):
+    effects = [step for step in steps if step[0] not in CHAIN_SETTINGS]
+    settings = [list(step) for step in steps if step[0] in CHAIN_SETTINGS]
+    resolved = [[name, list(params)] for name, params in simplify(effects)]
+    text = json.dumps({"engine": ENGINE_VERSION, "chain": resolved + settings}, separators=(",", ":"))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class Manifest:
+    # entries: absolute input path -> {"size", "mtime_ns", "sha256", "outputs": {chain key: output path}}
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data["entries"]
+        self.output_paths = {output for entry in self.entries.values() for output in entry["outputs"].values()}
+        # Hashes computed while checking files, reused when they are recorded
+        self.hashes = {}
+
+    # Every file this engine wrote, so that they are never taken as inputs
+    def is_output(self, path):
+        return os.path.abspath(path) in self.output_paths
+
+    # True when `image_path` was already processed with `steps` into `output_path` and has not
+    # changed since. Size and mtime are checked first, so only touched files are hashed again.
+    def is_current(self, image_path, steps, output_path):
+        image_path, output_path = os.path.abspath(image_path), os.path.abspath(output_path)
+        entry = self.entries.get(image_path)
+        if entry is None or entry["outputs"].get(chain_key(steps)) != output_path or not os.path.exists(output_path):
+            return False
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return False
+        if (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            return True
+        self.hashes[image_path] = file_hash(image_path)
+        if self.hashes[image_path] != entry["sha256"]:
+            return False
+        # Touched but not changed: remember the new mtime so it is not hashed again
+        entry["size"], entry["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        return True
+
+    # Record that `image_path` was processed with `steps` into `output_path`
+    def record(self, image_path, steps, output_path):
+        image_path, output_path = os.path.abspath(image_path), os.path.abspath(output_path)
+        stat = os.stat(image_path)
+        sha256 = self.hashes.pop(image_path, None) or file_hash(image_path)
+        entry = self.entries.get(image_path)
+        if entry is None or entry["sha256"] != sha256:
+            # New content: outputs made from the old content are out of date
+            entry = self.entries[image_path] = {"outputs": {}}
+        entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256)
+        entry["outputs"][chain_key(steps)] = output_path
+        self.output_paths.add(output_path)
+
+    # Write through a temporary file so an interrupted run never leaves a broken manifest
+    def save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f, separators=(",", ":"))
+        os.replace(temporary, self.path)
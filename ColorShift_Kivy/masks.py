@@ -0,0 +1,197 @@
+# masks.py
+# Masks of the pixels an effect recolors, computed once per image and reused: recoloring the same
+# mask with another color is then a single composite. A mask source is either a criterion tuple
+#   ("dark", threshold)                          every channel below the threshold (apply_color_mask uses 100)
+#   ("luminance", threshold)                     gray level (Pillow's "L") below the threshold
+#   ("hsv", hue_low, hue_high, min_s, min_v)     hue within [low, high] (wrapping when low > high), Pillow's 0-255 HSV scale
+#   ("border", threshold)                        dark pixels connected to the image border (see background.py)
+# or the path of a mask image exported earlier (white = masked), so one mask can serve a whole batch.
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+import background
+import instrumentation
+import kernels
+
+COLOR_MASK = ("dark", 100)
+CRITERIA = {"dark": 1, "luminance": 1, "hsv": 4, "border": 1}  # criterion -> number of parameters
+MASK_SUFFIX = "-mask"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+# Criterion tuple from text such as "dark:100", "luminance:80", "hsv:20-45:80:40" or "border:30"
+def parse_criterion(text):
+    name, _, rest = text.strip().lower().partition(":")
+    values = rest.replace("-", ":").split(":") if rest else []
+    try:
+        return normalize((name,) + tuple(int(v) for v in values))
+    except ValueError as e:
+        raise ValueError(f"invalid mask criterion '{text}' ({e})") from None
+
+
+# Text form of a criterion, the inverse of parse_criterion
+def criterion_text(criterion):
+    name, *values = criterion
+    if name == "hsv":
+        return f"hsv:{values[0]}-{values[1]}:{values[2]}:{values[3]}"
+    return f"{name}:{values[0]}"
+
+
+# A criterion as a tuple of ints after its name, or a mask file path unchanged
+def normalize(source):
+    if isinstance(source, str):
+        return source
+    name, *values = source
+    if name not in CRITERIA:
+        raise ValueError(f"unknown mask criterion '{name}', choose from {list(CRITERIA)}")
+    if len(values) != CRITERIA[name]:
+        raise ValueError(f"the {name} criterion takes {CRITERIA[name]} value(s), got {len(values)}")
+    values = [int(v) for v in values]
+    if not all(0 <= v <= 255 for v in values):
+        raise ValueError("mask criterion values must be between 0 and 255")
+    return (name, *values)
+
+
+# Border masks depend on the whole image; the other criteria on each pixel alone
+def needs_whole_image(source):
+    return not isinstance(source, str) and source[0] == "border"
+
+
+# Mask of a criterion over an RGB array, as a (height, width) bool array
+def compute_mask(rgb, criterion):
+    name, *values = criterion
+    if name == "border":
+        return background.border_connected_mask(rgb, values[0])
+    if name == "dark":
+        return background.dark_mask(rgb, values[0])
+    mask = np.empty(rgb.shape[:2], dtype=bool)
+    rows = max(1, kernels.CHUNK_PIXELS // max(1, rgb.shape[1]))
+    for top in range(0, len(rgb), rows):
+        band = Image.fromarray(np.ascontiguousarray(rgb[top:top + rows]))
+        if name == "luminance":
+            np.less(np.asarray(band.convert("L")), values[0], out=mask[top:top + rows])
+            continue
+        hsv = np.asarray(band.convert("HSV"))
+        hue_low, hue_high, min_saturation, min_value = values
+        hue = hsv[..., 0]
+        in_range = (hue >= hue_low) & (hue <= hue_high) if hue_low <= hue_high else (hue >= hue_low) | (hue <= hue_high)
+        mask[top:top + rows] = in_range & (hsv[..., 1] >= min_saturation) & (hsv[..., 2] >= min_value)
+    return mask
+
+
+# Paint the masked pixels a flat color (in place); mask rows line up with rgb's
+def composite(rgb, mask, color):
+    # One masked copy per channel plane is far cheaper than a boolean-indexed pixel assignment
+    for channel, value in enumerate(color[:3]):
+        np.copyto(rgb[..., channel], min(255, max(0, int(value))), where=mask)
+    return rgb
+
+
+# Write a mask as a 1-bit PNG (white = masked)
+def save_mask(mask, path):
+    with instrumentation.timed_io("save", path):
+        Image.fromarray(mask).save(path)
+
+
+# Read a mask image, scaled to `size` (width, height) with nearest-neighbour sampling when it differs
+def load_mask(path, size=None):
+    with instrumentation.timed_io("load", path):
+        with Image.open(path) as img:
+            mask = img.convert("L")
+    if size is not None and mask.size != tuple(size):
+        mask = mask.resize(size, Image.NEAREST)
+    return np.asarray(mask) > 127
+
+
+class MaskCache:
+    # Masks packed to one bit per pixel row by row, keyed by (image key, source) and bounded by total
+    # bytes with LRU eviction like prefix_cache.py. The image key is anything that identifies the
+    # pixels the mask is computed from, e.g. prefix_cache.source_key(). Rows are packed on their own
+    # so that a strip unpacks only its rows (see mask_rows).
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (width, packed rows), least recently used first
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # The cached mask of a key, or only its rows [top, bottom) when rows=(top, bottom)
+    def get(self, key, rows=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        width, packed = entry
+        if rows is not None:
+            packed = packed[rows[0]:rows[1]]
+        return np.unpackbits(packed, axis=1, count=width).view(bool)
+
+    def put(self, key, mask):
+        packed = np.packbits(mask, axis=1)
+        with self.lock:
+            if key in self.entries:
+                return mask
+            self.entries[key] = (mask.shape[1], packed)
+            self.current_bytes += packed.nbytes
+            # Evict least recently used masks, but always keep the one just added
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+        return mask
+
+    # Mask of `source` over an image (PIL image or RGB array) identified by `image_key`;
+    # the image is only read when the mask is not cached yet
+    def mask_for(self, image_key, source, image):
+        if isinstance(source, str):
+            return self.file_mask(source, image.size if isinstance(image, Image.Image) else (image.shape[1], image.shape[0]))
+        key = (image_key, source)
+        mask = self.get(key)
+        if mask is None:
+            rgb = kernels.to_array(image)[0] if isinstance(image, Image.Image) else image
+            mask = self.put(key, compute_mask(rgb, source))
+        return mask
+
+    # An exported mask file at the given size (width, height), read once per file version; rows=(top,
+    # bottom) returns only those rows
+    def file_mask(self, path, size, rows=None):
+        path = os.path.abspath(path)
+        key = (("file", path, os.path.getmtime(path)), tuple(size))
+        mask = self.get(key, rows)
+        if mask is None:
+            mask = self.put(key, load_mask(path, size))
+            if rows is not None:
+                mask = mask[rows[0]:rows[1]]
+        return mask
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.current_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+
+# Shared by every pipeline and ColorShift instance of the process
+mask_cache = MaskCache()
+
+
+# Mask rows of rgb, which holds rows [top, top + len(rgb)) of an image `height` rows tall: from the
+# full-size `precomputed` mask, from a mask file (unpacking only these rows of the cached mask), else
+# computed from rgb (the whole image for border masks)
+def mask_rows(rgb, source, top=0, height=None, precomputed=None):
+    height = len(rgb) if height is None else height
+    if precomputed is not None:
+        return precomputed[top:top + len(rgb)]
+    if isinstance(source, str):
+        return mask_cache.file_mask(source, (rgb.shape[1], height), (top, top + len(rgb)))
+    return compute_mask(rgb, source)
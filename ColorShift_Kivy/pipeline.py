@@ -0,0 +1,234 @@
+# pipeline.py
+# Run an ordered chain of ColorShift effects with one decode, fused per-pixel passes and one encode
+from contextlib import nullcontext
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+import background
+import encoders
+import filters
+import gradients
+import instrumentation
+import kernels
+import lut
+import masks
+import presets
+
+# Version of the pixel engine; bump it whenever a change to the kernels changes output pixels, so that
+# incremental runs (see manifest.py) redo outputs made by the old code
+ENGINE_VERSION = 2
+
+# Effects that only depend on the (r, g, b) value of a pixel and can share one pass
+PIXEL_OPERATIONS = set(lut.OPERATIONS)
+
+# Effects that need the whole image (position or neighbourhood dependent)
+IMAGE_OPERATIONS = {"apply_gradient", "apply_sharpen_blur", "apply_transparency", "replace_border_background", "apply_mask", *filters.OPERATIONS}
+
+SHARPEN_BLUR_FILTERS = {"sharpen": ImageFilter.SHARPEN, "blur": ImageFilter.BLUR}
+
+# A compiled table pays for itself once it replaces the direct pass on this many times its size in
+# pixels: building an exact table costs about 60 ns per entry and a lookup saves about 8 ns per pixel
+# over a two-step group
+LUT_PAYBACK = 8
+
+
+# Turn a list of ColorShift method calls into the internal step list, dropping steps with no effect
+def simplify(steps):
+    expanded = []
+    for name, *params in steps:
+        params = tuple(tuple(p) if isinstance(p, list) else p for p in params)
+        if name == "adjust_contrast_brightness":
+            contrast_factor, brightness_factor = params
+            expanded.append(("contrast", (float(contrast_factor),)))
+            expanded.append(("brightness", (float(brightness_factor),)))
+        elif name == "apply_gradient":
+            # Fill in the default shape and alpha so equal gradients always compare equal
+            color1, color2, shape, alpha = (params + ("vertical", gradients.DEFAULT_ALPHA)[len(params) - 2:])[:4]
+            if shape not in gradients.GRADIENT_SHAPES:
+                raise ValueError(f"Unknown gradient shape '{shape}'. Choose one from {list(gradients.GRADIENT_SHAPES)}")
+            expanded.append((name, (tuple(color1[:3]), tuple(color2[:3]), shape, float(alpha))))
+        elif name == "replace_border_background":
+            color, threshold, feather = (params + (background.DEFAULT_THRESHOLD, background.DEFAULT_FEATHER)[len(params) - 1:])[:3]
+            expanded.append((name, (tuple(color[:3]), int(threshold), int(feather))))
+        elif name in filters.OPERATIONS:
+            expanded.append((name, filters.normalize(name, params)))
+        elif name == "apply_mask":
+            # The mask comes from a criterion or a mask file (see masks.py)
+            color, source = params
+            expanded.append((name, (tuple(color[:3]), masks.normalize(source))))
+        elif name == "apply_color_preset":
+            # Presets run as their matrix so consecutive ones can be combined (see presets.fuse_linear)
+            expanded.append(("color_matrix", (presets.preset_matrix(params[0]),)))
+        elif name == "color_matrix":
+            expanded.append((name, (presets.to_matrix(params[0]),)))
+        elif name in PIXEL_OPERATIONS or name in IMAGE_OPERATIONS:
+            expanded.append((name, params))
+        else:
+            raise ValueError(f"Unknown operation '{name}'")
+
+    simplified = []
+    for name, params in expanded:
+        # A factor of 1.0 blends the image with itself
+        if name in ("contrast", "brightness") and params[0] == 1.0:
+            continue
+        # A zero alpha blends nothing of the gradient in
+        if name == "apply_gradient" and params[3] == 0.0:
+            continue
+        # Unknown sharpen/blur effects leave the image untouched
+        if name == "apply_sharpen_blur" and params[0] not in SHARPEN_BLUR_FILTERS:
+            continue
+        # So do a zero radius and a zero-percent unsharp mask
+        if name in filters.OPERATIONS and filters.is_identity(name, params):
+            continue
+        # Black and white is idempotent
+        if name == "convert_to_black_and_white" and simplified and simplified[-1][0] == name:
+            continue
+        simplified.append((name, params))
+
+    # Transparency only sets the alpha band, which no other step reads, so only the last one matters
+    transparency = [step for step in simplified if step[0] == "apply_transparency"]
+    simplified = [step for step in simplified if step[0] != "apply_transparency"] + transparency[-1:]
+    return simplified
+
+
+# Per-pixel steps that fuse_linear may merge with their neighbours (contrast once its mean is known)
+AFFINE_OPERATIONS = {"contrast", "brightness", "color_matrix"}
+
+
+# True when running steps[:k] and then steps[k:] on its result gives the same pixels as running all
+# the steps at once. Only a run of affine steps fused across the split would round differently.
+def can_split(steps, k):
+    head = [step for step in simplify(steps[:k]) if step[0] != "apply_transparency"]
+    tail = [step for step in simplify(steps[k:]) if step[0] != "apply_transparency"]
+    if not head or not tail:
+        return True
+    return not (head[-1][0] in AFFINE_OPERATIONS and tail[0][0] in AFFINE_OPERATIONS - {"contrast"})
+
+
+class Pipeline:
+    # steps: ordered (method name, *params) tuples, e.g. ("apply_color_preset", "sepia")
+    def __init__(self, steps=(), lut_size=lut.EXACT):
+        self.steps = [tuple(step) for step in steps]
+        self.lut_size = lut_size
+        self.stages = self.plan(simplify(self.steps))
+        # Pixels pushed through each fused group, to tell when compiling it into a LUT pays off
+        self.pixels_seen = {}
+
+    # Group neighbouring per-pixel steps together; contrast starts a new group since it needs the image mean
+    @staticmethod
+    def plan(steps):
+        stages = []
+        for name, params in steps:
+            if name in PIXEL_OPERATIONS:
+                if stages and stages[-1][0] == "pixels" and name != "contrast":
+                    stages[-1][1].append((name, params))
+                else:
+                    stages.append(("pixels", [(name, params)]))
+            else:
+                stages.append((name, params))
+        return stages
+
+    # Apply the chain to an image and return the result. A key that identifies the image (e.g.
+    # prefix_cache.source_key) lets mask stages reuse the masks cached for it (see masks.py).
+    def run(self, img, key=None):
+        rgb, alpha = kernels.to_array(img)
+        rgb, alpha = self.run_stages(rgb, alpha, self.stages, key=key)
+        return kernels.from_array(rgb, alpha)
+
+    # Hashable form of a list of stages
+    @staticmethod
+    def stage_key(stages):
+        return tuple((kind, tuple(payload) if kind == "pixels" else payload) for kind, payload in stages)
+
+    # Apply stages to rows [top, top + len(rgb)) of an image that is `height` rows tall.
+    # precomputed maps the index of a stage that depends on the whole image to what it needs of it:
+    # the image mean of a stage starting with contrast, the full-size mask of a border background or
+    # border mask stage. Without it these are taken from rgb, which must then be the whole image.
+    # key identifies the input image (see Pipeline.run); mask stages then reuse cached masks.
+    def run_stages(self, rgb, alpha, stages, top=0, height=None, precomputed=None, key=None):
+        height = len(rgb) if height is None else height
+        for index, (kind, payload) in enumerate(stages):
+            value = None if precomputed is None else precomputed.get(index)
+            if kind == "apply_mask" and value is None and key is not None and len(rgb) == height:
+                # The image a stage sees is fixed by the input image and the stages before it
+                value = masks.mask_cache.mask_for((key, self.stage_key(stages[:index])), payload[1], rgb)
+            # Strips are reported as a whole by streaming.py, not one event per strip and stage
+            timer = instrumentation.operation(self.stage_name(kind, payload), (rgb.shape[1], height)) if len(rgb) == height else nullcontext()
+            with timer:
+                rgb, alpha = self.run_stage(rgb, alpha, kind, payload, top, height, value)
+        return rgb, alpha
+
+    def run_stage(self, rgb, alpha, kind, payload, top, height, precomputed):
+        if kind == "pixels":
+            self.run_pixel_group(rgb, payload, precomputed, (height - top) * rgb.shape[1])
+        elif kind == "apply_transparency":
+            alpha = Image.new("L", (rgb.shape[1], rgb.shape[0]), payload[0])
+        elif kind == "apply_gradient":
+            rgb = self.blend_gradient(rgb, payload, top, height)
+        elif kind == "replace_border_background":
+            color, threshold, feather = payload
+            mask = background.border_connected_mask(rgb, threshold) if precomputed is None else precomputed
+            background.fill_background(rgb, color, mask, feather, top)
+        elif kind in filters.OPERATIONS:
+            rgb = filters.apply(rgb, kind, payload)
+        elif kind == "apply_mask":
+            color, source = payload
+            masks.composite(rgb, masks.mask_rows(rgb, source, top, height, precomputed), color)
+        else:
+            rgb = np.array(kernels.from_array(rgb).filter(SHARPEN_BLUR_FILTERS[payload[0]]))
+        return rgb, alpha
+
+    # Event name of a stage: a fused group is named after its steps, e.g. "contrast+brightness"
+    @staticmethod
+    def stage_name(kind, payload):
+        if kind == "pixels":
+            return "+".join(name for name, _ in payload)
+        return kind
+
+    # Run a fused group in one pass over the pixels, through a compiled LUT once it is worth it.
+    # remaining counts the pixels from these rows to the end of the image (the rows alone by default).
+    def run_pixel_group(self, rgb, group, mean=None, remaining=None):
+        # The contrast mean changes with every image, so a table of a group that starts with contrast
+        # would be built for one image and never used again: such groups always run directly
+        compilable = group[0][0] != "contrast"
+        if not compilable:
+            factor = group[0][1][0]
+            mean = kernels.contrast_mean(rgb) if mean is None else mean
+            group = [("contrast", (factor, mean))] + group[1:]
+        # Consecutive affine steps (presets, contrast, brightness) become one matrix before any pixel is touched
+        group = presets.fuse_linear(group)
+        key = tuple(group)
+        pixels = rgb.shape[0] * rgb.shape[1]
+        if compilable and len(group) > 1 and self.lut_pays_off(key, pixels, pixels if remaining is None else remaining):
+            lut.compile_chain(key, self.lut_size).apply_array(rgb)
+            return
+        for band in kernels.iter_bands(rgb):
+            for name, params in group:
+                lut.OPERATIONS[name](band, *params)
+
+    # A table pays off when the pixels still to come cover LUT_PAYBACK times its size. Those are the
+    # rest of this image, or, as an estimate for batches (one Pipeline runs every image of a chain),
+    # as many again as the group has run over already.
+    def lut_pays_off(self, key, pixels, remaining):
+        seen = self.pixels_seen.get(key, 0)
+        self.pixels_seen[key] = seen + pixels
+        return max(seen, remaining) >= LUT_PAYBACK * self.lut_size ** 3
+
+    # Blend rows [top, top + len(rgb)) of the two-color gradient over the pixels (see gradients.py)
+    @staticmethod
+    def blend_gradient(rgb, params, top, height):
+        color1, color2, shape, alpha = params
+        return gradients.blend_gradient(rgb, color1, color2, shape, alpha, top, height)
+
+    # Decode once, run the whole chain, encode once with the options of an output profile
+    # (see encoders.py); explicit save options override the profile's
+    def process(self, input_path, output_path, profile=encoders.DEFAULT_PROFILE, **save_options):
+        with instrumentation.timed_io("load", input_path):
+            with Image.open(input_path) as source:
+                img = source.convert("RGB")
+        result = self.run(img)
+        save_options = {**encoders.save_options(output_path, profile), **save_options}
+        with instrumentation.timed_io("save", output_path, profile=profile):
+            result.save(output_path, **save_options)
+        return result
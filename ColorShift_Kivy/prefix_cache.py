@@ -0,0 +1,108 @@
+# prefix_cache.py
+# Intermediate results of effect chains, keyed by the source image and the steps that made them,
+# so that changing a late step only re-runs the steps after the deepest cached prefix.
+# Bounded by total bytes with LRU eviction, like image_cache.py.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import kernels
+from pipeline import Pipeline, can_split
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+# Key of a source image: its file version when it is the decoded file, else a hash of its pixels
+def source_key(img, path=None):
+    if path is not None:
+        path = os.path.abspath(path)
+        return ("file", path, os.path.getmtime(path))
+    digest = hashlib.blake2b(img.tobytes(), digest_size=16).hexdigest()
+    return ("pixels", img.mode, img.size, digest)
+
+
+# Steps as nested tuples, so that lists of colors from the GUI and tuples compare equal
+def _freeze(steps):
+    return tuple(tuple(tuple(p) if isinstance(p, list) else p for p in step) for step in steps)
+
+
+def _run_pipeline(img, steps, progress=None):
+    return Pipeline(steps).run(img)
+
+
+class PrefixCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (source key, step prefix) -> image, least recently used first
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(img):
+        return img.width * img.height * len(img.getbands())
+
+    # Deepest cached prefix of `steps`: (its length, its image), or (0, None). A prefix only counts
+    # where the chain can be split (see pipeline.can_split), or the result would depend on what was
+    # rendered before.
+    def deepest(self, key, steps):
+        lengths = [k for k in range(len(steps), 0, -1) if k == len(steps) or can_split(steps, k)]
+        with self.lock:
+            for k in lengths:
+                entry = (key, steps[:k])
+                if entry in self.entries:
+                    self.entries.move_to_end(entry)
+                    self.hits += 1
+                    return k, self.entries[entry]
+            self.misses += 1
+        return 0, None
+
+    def put(self, key, prefix, img):
+        with self.lock:
+            entry = (key, prefix)
+            if entry in self.entries:
+                return
+            self.entries[entry] = img
+            self.current_bytes += self.image_bytes(img)
+            # Evict least recently used results, but always keep the one just added
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= self.image_bytes(evicted)
+
+    # Run `steps` over `img` (the source identified by `key`) from the deepest cached prefix on.
+    # The remaining steps run in segments that end at every point where splitting the chain does not
+    # change the pixels (see pipeline.can_split), and each segment's result is cached.
+    # run(img, segment, progress) renders one segment (Pipeline.run by default); progress(fraction)
+    # covers the whole call. Results are shared: callers must copy them before changing them in place.
+    def render(self, key, img, steps, run=_run_pipeline, progress=None):
+        steps = _freeze(steps)
+        # Integer and float kernels give different pixels (see kernels.py)
+        key = (key, kernels.integer_mode())
+        start, cached = self.deepest(key, steps)
+        if cached is not None:
+            img = cached
+        ends = [k for k in range(start + 1, len(steps)) if can_split(steps, k)] + [len(steps)]
+        begin = start
+        for index, end in enumerate(ends if start < len(steps) else []):
+            segment_progress = None
+            if progress:
+                segment_progress = lambda fraction, index=index: progress((index + fraction) / len(ends))
+            img = run(img, steps[begin:end], segment_progress)
+            self.put(key, steps[:end], img)
+            begin = end
+        return img
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.current_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+
+# Shared by every ColorShift instance of the process
+prefix_cache = PrefixCache()
@@ -0,0 +1,145 @@
+# presets.py
+# Color presets as 3x4 affine matrices, plus a registry for user presets loaded from JSON.
+# A matrix is a flat 12-tuple of rows (r, g, b, offset) for the red, green and blue outputs,
+# the layout Image.convert("RGB", matrix) takes.
+import json
+import os
+
+BUILTIN_PRESETS = {
+    "sepia": (0.393, 0.769, 0.189, 0.0, 0.349, 0.686, 0.168, 0.0, 0.272, 0.534, 0.131, 0.0),
+    "cool": (0.8, 0.0, 0.0, 0.0, 0.0, 0.9, 0.0, 0.0, 0.0, 0.0, 1.1, 0.0),
+    "warm": (1.1, 0.0, 0.0, 0.0, 0.0, 0.9, 0.0, 0.0, 0.0, 0.0, 0.8, 0.0),
+    "vintage": (0.9, 0.7, 0.4, 0.0, 0.6, 0.5, 0.3, 0.0, 0.3, 0.2, 0.1, 0.0),
+}
+
+PRESETS = dict(BUILTIN_PRESETS)
+
+# User presets file: {"name": [[r, g, b, offset], [r, g, b, offset], [r, g, b, offset]], ...}
+# (offsets may be left out). COLORSHIFT_PRESETS points to another file.
+USER_PRESETS_PATH = os.environ.get("COLORSHIFT_PRESETS", os.path.join(os.path.expanduser("~"), ".colorshift", "presets.json"))
+
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+
+# Validate 3 rows of 3 or 4 numbers (or a flat 9/12-tuple) and return the flat 12-tuple
+def to_matrix(rows):
+    rows = list(rows)
+    if rows and all(isinstance(row, (list, tuple)) for row in rows):
+        if len(rows) != 3 or any(len(row) not in (3, 4) for row in rows):
+            raise ValueError("A preset needs 3 rows of 3 or 4 numbers (r, g, b and an optional offset)")
+        return tuple(float(v) for row in rows for v in (tuple(row) + (0.0,))[:4])
+    if len(rows) == 9:
+        return tuple(float(v) for i in range(3) for v in tuple(rows[3 * i:3 * i + 3]) + (0.0,))
+    if len(rows) == 12:
+        return tuple(float(v) for v in rows)
+    raise ValueError("A flat preset matrix needs 9 or 12 numbers")
+
+
+def register_preset(name, rows):
+    PRESETS[name.lower().strip()] = to_matrix(rows)
+
+
+def preset_names():
+    return list(PRESETS)
+
+
+def preset_matrix(name):
+    if name not in PRESETS:
+        raise ValueError(f"Unknown preset '{name}'. Choose one from {preset_names()}")
+    return PRESETS[name]
+
+
+# Steps with every named preset replaced by its matrix, for worker processes: they load the presets
+# file on their own and never see presets registered in this process (e.g. from --presets)
+def resolve_presets(steps):
+    return tuple(("color_matrix", preset_matrix(step[1])) if step[0] == "apply_color_preset" else tuple(step) for step in steps)
+
+
+# Register every preset of a JSON file and return their names (a missing file registers nothing)
+def load_presets(path=USER_PRESETS_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        entries = json.load(f)
+    if not isinstance(entries, dict):
+        raise ValueError(f"{path} must hold an object mapping preset names to matrices")
+    # Every entry is checked before any is registered, so a bad file registers nothing
+    matrices = {}
+    for name, rows in entries.items():
+        try:
+            matrices[name.lower().strip()] = to_matrix(rows)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"preset '{name}': {e}") from None
+    PRESETS.update(matrices)
+    return list(matrices)
+
+
+# The matrix applying `first` and then `second`
+def compose(second, first):
+    out = []
+    for i in range(3):
+        row = second[4 * i:4 * i + 4]
+        for j in range(4):
+            value = sum(row[k] * first[4 * k + j] for k in range(3))
+            out.append(value + row[3] if j == 3 else value)
+    return tuple(out)
+
+
+# factor * pixel + offset on every channel
+def scale_matrix(factor, offset=0.0):
+    return (factor, 0.0, 0.0, offset, 0.0, factor, 0.0, offset, 0.0, 0.0, factor, offset)
+
+
+# The matrix of a per-pixel step if it is affine, else None.
+# Contrast blends towards its mean gray and brightness towards black, so both are scalings.
+def linear_matrix(name, params):
+    if name == "apply_color_preset":
+        return preset_matrix(params[0])
+    if name == "color_matrix":
+        return to_matrix(params[0])
+    if name == "brightness":
+        return scale_matrix(params[0])
+    if name == "contrast" and len(params) > 1:
+        factor, mean = params
+        return scale_matrix(factor, (1 - factor) * mean)
+    return None
+
+
+# Corners of the RGB cube: an affine map keeps every color in [0, 255] when it keeps these
+CUBE_CORNERS = [(r, g, b) for r in (0, 255) for g in (0, 255) for b in (0, 255)]
+
+
+# True when the matrix maps every color inside [0, 255], so clamping its output changes nothing
+def keeps_range(matrix):
+    for corner in CUBE_CORNERS:
+        for i in range(3):
+            value = sum(matrix[4 * i + k] * corner[k] for k in range(3)) + matrix[4 * i + 3]
+            if not 0 <= value <= 255:
+                return False
+    return True
+
+
+# Combine each run of consecutive affine steps of a fused pixel group into one color_matrix step.
+# Each step clamps its output to [0, 255], so a run only grows while the steps combined so far keep
+# every color in range; otherwise the next step starts a new run. A single affine step is kept as
+# it is so that it keeps its exact kernel.
+def fuse_linear(group):
+    fused = []
+    run = []
+    combined = IDENTITY
+    for name, params in list(group) + [(None, ())]:
+        matrix = linear_matrix(name, params) if name else None
+        if run and (matrix is None or not keeps_range(combined)):
+            fused.append(run[0] if len(run) == 1 else ("color_matrix", (combined,)))
+            run, combined = [], IDENTITY
+        if matrix is not None:
+            run.append((name, params))
+            combined = compose(matrix, combined)
+        elif name:
+            fused.append((name, params))
+    return fused
+
+try:
+    load_presets()
+except (OSError, ValueError) as e:
+    print(f"Could not load user presets from {USER_PRESETS_PATH}: {e}")
@@ -0,0 +1,300 @@
+# streaming.py
+# Process images strip by strip. Peak memory is bounded by the strip size, not the image size, only
+# for sources Pillow stores as raw rows (BMP, PPM, uncompressed TIFF strips): those are decoded one
+# strip at a time. Compressed sources (JPEG, PNG, ...) are decoded whole once, at 3 bytes per pixel,
+# and only the processing and the output are done strip by strip.
+import io
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image, ImageFile
+
+import background
+import encoders
+import filters
+import instrumentation
+import kernels
+import masks
+from pipeline import Pipeline, SHARPEN_BLUR_FILTERS
+
+STRIP_HEIGHT = 256
+
+# Whether partial decoding works with this Pillow: None until checked (see partial_decode_supported)
+_partial_decode = None
+
+
+# Partial decoding rewrites private Pillow fields (Image._size, TiffImageFile._tile_size and the
+# ImageFile._Tile layout), which no Pillow release promises to keep. So it is checked once per process
+# by decoding a few rows of a small bottom-up BMP in memory; when that fails or gives other pixels,
+# every source is decoded whole instead.
+def partial_decode_supported():
+    global _partial_decode
+    if _partial_decode is None:
+        _partial_decode = False
+        pixels = np.arange(8 * 4 * 3, dtype=np.uint8).reshape(8, 4, 3)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, "BMP")
+        try:
+            reader = StripReader(buffer)
+            _partial_decode = hasattr(ImageFile, "_Tile") and np.array_equal(reader._read_partial(2, 6), pixels[2:6])
+        except Exception:
+            _partial_decode = False
+    return _partial_decode
+
+
+class StripReader:
+    # Uncompressed formats (BMP, PPM, raw TIFF strips) are decoded one strip at a time when this
+    # Pillow supports it (see partial_decode_supported). Compressed ones (PNG, JPEG, ...) cannot be
+    # decoded partially by Pillow, so they are decoded once into a compact 3-bytes-per-pixel image
+    # and cut into strips from there. path may also be a binary file object.
+    def __init__(self, path):
+        self.path = path
+        with Image.open(path) as img:
+            self.size = img.size
+            self.mode = img.mode
+            self.tiles = list(img.tile)
+            # Pillow rotates TIFFs with an EXIF orientation after loading, which a window cannot follow
+            upright = img.getexif().get(0x0112, 1) == 1
+        self.streamable = upright and bool(self.tiles) and all(self._is_row_tile(tile) for tile in self.tiles) and partial_decode_supported()
+        self.full = None
+
+    def _is_row_tile(self, tile):
+        return tile[0] == "raw" and tile[1][0] == 0 and tile[1][2] == self.size[0]
+
+    # Bytes per row of a raw tile (a stride of 0 means tightly packed rows)
+    def _stride(self, rawmode, stride):
+        if stride:
+            return stride
+        return len(Image.new(self.mode, (self.size[0], 1)).tobytes("raw", rawmode))
+
+    # Rows [top, bottom) as an RGB array
+    def read(self, top, bottom):
+        if self.streamable:
+            try:
+                return self._read_partial(top, bottom)
+            except Exception:
+                self.streamable = False
+        if self.full is None:
+            with Image.open(self.path) as img:
+                self.full = img.convert("RGB")
+        return np.array(self.full.crop((0, top, self.size[0], bottom)))
+
+    # Point each raw tile at just the rows we need and let Pillow decode that window
+    def _read_partial(self, top, bottom):
+        width = self.size[0]
+        tiles = []
+        for name, (_, y0, _, y1), offset, args in self.tiles:
+            start, end = max(y0, top), min(y1, bottom)
+            if start >= end:
+                continue
+            rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+            stride = self._stride(rawmode, stride)
+            # Bottom-up tiles (BMP) store their last row first
+            first_row = start - y0 if orientation >= 0 else y1 - end
+            tiles.append(ImageFile._Tile(name, (0, start - top, width, end - top), offset + first_row * stride, (rawmode, stride, orientation)))
+        with Image.open(self.path) as img:
+            img._size = (width, bottom - top)
+            if hasattr(img, "_tile_size"):
+                img._tile_size = img._size
+            img.tile = tiles
+            img.load()
+            return np.array(img.convert("RGB"))
+
+
+class PngStripWriter:
+    # Writes a PNG incrementally: one zlib stream over unfiltered rows, flushed as IDAT chunks
+    def __init__(self, path, width, height, has_alpha=False, compress_level=6):
+        self.file = open(path, "wb")
+        self.compressor = zlib.compressobj(compress_level)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6 if has_alpha else 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write(self, pixels):
+        rows = np.zeros((pixels.shape[0], 1 + pixels.shape[1] * pixels.shape[2]), dtype=np.uint8)
+        rows[:, 1:] = pixels.reshape(pixels.shape[0], -1)
+        data = self.compressor.compress(rows.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+
+class PpmStripWriter:
+    # Binary PPM (P6); has no alpha channel
+    def __init__(self, path, width, height, has_alpha=False):
+        if has_alpha:
+            raise ValueError("PPM output cannot store transparency; use a .png output path")
+        self.file = open(path, "wb")
+        self.file.write(f"P6\n{width} {height}\n255\n".encode())
+
+    def write(self, pixels):
+        self.file.write(np.ascontiguousarray(pixels).tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class ImageStripWriter:
+    # Fallback for formats Pillow can only encode in one go (JPEG, BMP, ...): strips are pasted
+    # into one compact output image that is saved at the end
+    def __init__(self, path, width, height, has_alpha=False, save_options=None):
+        self.path = path
+        self.save_options = save_options or {}
+        self.img = Image.new("RGBA" if has_alpha else "RGB", (width, height))
+        self.top = 0
+
+    def write(self, pixels):
+        self.img.paste(Image.fromarray(np.ascontiguousarray(pixels)), (0, self.top))
+        self.top += pixels.shape[0]
+
+    def close(self):
+        self.img.save(self.path, **self.save_options)
+
+
+# Writer for the format of `path`, encoding with the options of an output profile (see encoders.py).
+# PNG strips are compressed as they come, so "optimize" becomes the highest zlib level.
+def open_writer(path, width, height, has_alpha=False, profile=encoders.DEFAULT_PROFILE):
+    options = encoders.save_options(path, profile)
+    extension = path.lower().rsplit(".", 1)[-1]
+    if extension == "png":
+        compress_level = 9 if options.get("optimize") else options.get("compress_level", 6)
+        return PngStripWriter(path, width, height, has_alpha, compress_level)
+    if extension in ("ppm", "pnm"):
+        return PpmStripWriter(path, width, height, has_alpha)
+    return ImageStripWriter(path, width, height, has_alpha, options)
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class ImageStripReader:
+    # Serves strips of an image that is already decoded in memory
+    def __init__(self, img):
+        self.size = img.size
+        self.rgb, _ = kernels.to_array(img)
+
+    def read(self, top, bottom):
+        return self.rgb[top:bottom].copy()
+
+
+# Rows of context a stage reads on each side of a row: half the kernel height of a sharpen/blur
+# stage (1 for the 3x3 SHARPEN, 2 for the 5x5 BLUR), the reach of a variable-radius filter
+def _stage_halo(kind, payload):
+    if kind == "apply_sharpen_blur":
+        return SHARPEN_BLUR_FILTERS[payload[0]].filterargs[0][1] // 2
+    if kind in filters.OPERATIONS:
+        return filters.halo(kind, payload)
+    return 0
+
+
+# Yield (top, bottom, rgb, alpha) for each output strip after running `stages` on it.
+# Strips are read with the halo of rows the filter stages need (the sum of theirs) and cropped back
+# afterwards. Strips grow to filters.TILE_HALOS halos so large blur radii do not spend most of the work on halo rows.
+# progress(fraction) is called after each strip; setting cancel_event stops before the next one.
+def iter_strips(reader, pipeline, stages, precomputed, strip_height=STRIP_HEIGHT, progress=None, cancel_event=None):
+    width, height = reader.size
+    halo = sum(_stage_halo(kind, payload) for kind, payload in stages)
+    strip_height = max(strip_height, filters.TILE_HALOS * halo)
+    for top in range(0, height, strip_height):
+        if cancel_event is not None and cancel_event.is_set():
+            raise RenderCancelled()
+        bottom = min(height, top + strip_height)
+        read_top, read_bottom = max(0, top - halo), min(height, bottom + halo)
+        rgb = reader.read(read_top, read_bottom)
+        rgb, alpha = pipeline.run_stages(rgb, None, stages, read_top, height, precomputed)
+        rgb = rgb[top - read_top:bottom - read_top]
+        if alpha is not None:
+            alpha = np.array(alpha)[top - read_top:bottom - read_top]
+        yield top, bottom, rgb, alpha
+        if progress:
+            progress(bottom / height)
+
+
+# Threshold of the border-connected dark mask a stage needs, or None (see background.py and masks.py)
+def _border_threshold(kind, payload):
+    if kind == "replace_border_background":
+        return payload[1]
+    if kind == "apply_mask" and masks.needs_whole_image(payload[1]):
+        return payload[1][1]
+    return None
+
+
+# What the stages that depend on the whole image need of it, one streamed pass each over the
+# image before that stage: the gray-level mean a contrast step blends against, and the full-size
+# mask of the dark area connected to the border for a border background or border mask step (one
+# byte per pixel, see background.py). Returns them by stage index, and the number of passes the
+# render takes in total.
+def _precompute(reader, pipeline, strip_height, progress, cancel_event):
+    whole_image_stages = [index for index, (kind, payload) in enumerate(pipeline.stages)
+                          if (kind == "pixels" and payload[0][0] == "contrast") or _border_threshold(kind, payload) is not None]
+    passes = len(whole_image_stages) + 1
+    precomputed = {}
+    for done, index in enumerate(whole_image_stages):
+        pass_progress = (lambda fraction, done=done: progress((done + fraction) / passes)) if progress else None
+        strips = iter_strips(reader, pipeline, pipeline.stages[:index], precomputed, strip_height, pass_progress, cancel_event)
+        threshold = _border_threshold(*pipeline.stages[index])
+        if threshold is not None:
+            width, height = reader.size
+            dark = np.empty((height, width), dtype=bool)
+            for top, bottom, rgb, _ in strips:
+                dark[top:bottom] = background.dark_mask(rgb, threshold)
+            precomputed[index] = background.border_connected_dark(dark)
+            continue
+        histogram = np.zeros(256, dtype=np.int64)
+        for _, _, rgb, _ in strips:
+            histogram += np.array(Image.fromarray(np.ascontiguousarray(rgb)).convert("L").histogram(), dtype=np.int64)
+        total = 0
+        for i in range(256):
+            total += i * int(histogram[i])
+        precomputed[index] = int(total / int(histogram.sum()) + 0.5)
+    return precomputed, passes
+
+
+def _run_strips(reader, steps, strip_height, progress, cancel_event):
+    pipeline = Pipeline(steps)
+    precomputed, passes = _precompute(reader, pipeline, strip_height, progress, cancel_event)
+    final_progress = (lambda fraction: progress((passes - 1 + fraction) / passes)) if progress else None
+    has_alpha = any(kind == "apply_transparency" for kind, _ in pipeline.stages)
+    return has_alpha, iter_strips(reader, pipeline, pipeline.stages, precomputed, strip_height, final_progress, cancel_event)
+
+
+# Run an effect chain from input_path to output_path strip by strip.
+# The output matches Pipeline(steps).process() pixel for pixel.
+def stream_process(input_path, output_path, steps, strip_height=STRIP_HEIGHT, progress=None, cancel_event=None, profile=encoders.DEFAULT_PROFILE):
+    reader = StripReader(input_path)
+    width, height = reader.size
+    with instrumentation.operation("stream_process", reader.size, steps=len(steps), path=str(input_path)):
+        has_alpha, strips = _run_strips(reader, steps, strip_height, progress, cancel_event)
+        writer = open_writer(output_path, width, height, has_alpha, profile)
+        try:
+            for _, _, rgb, alpha in strips:
+                writer.write(rgb if alpha is None else np.dstack([rgb, alpha]))
+        finally:
+            writer.close()
+
+
+# Render an effect chain over an in-memory image strip by strip, so that it can report
+# progress and be cancelled between strips. Matches Pipeline(steps).run() pixel for pixel.
+def render_image(img, steps, strip_height=STRIP_HEIGHT, progress=None, cancel_event=None):
+    reader = ImageStripReader(img)
+    width, height = reader.size
+    with instrumentation.operation("render_image", reader.size, steps=len(steps)):
+        has_alpha, strips = _run_strips(reader, steps, strip_height, progress, cancel_event)
+        out = np.empty((height, width, 4 if has_alpha else 3), dtype=np.uint8)
+        for top, bottom, rgb, alpha in strips:
+            out[top:bottom, :, :3] = rgb
+            if has_alpha:
+                out[top:bottom, :, 3] = alpha
+    result = Image.fromarray(out)
+    # Like Pipeline.run, an alpha band of the input is kept when no step replaces it
+    if img.mode == "RGBA" and not has_alpha:
+        result.putalpha(img.getchannel("A"))
+    return result
@@ -0,0 +1,172 @@
+# thumbnails.py
+# Thumbnails of the file chooser, kept on disk across sessions and made by background threads
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_cache import fit_size, load_preview
+
+THUMBNAIL_SIZE = (128, 128)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".colorshift", "thumbnails")
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+THUMBNAIL_WORKERS = 2
+
+
+class ThumbnailCache:
+    # One JPEG per (path, size, mtime) in `folder`, evicted least recently used first once the folder
+    # holds more than max_bytes. A file's mtime is its last use, so the order survives restarts.
+    def __init__(self, folder=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        entries = []
+        for name in os.listdir(folder):
+            if name.endswith(".jpg"):
+                stat = os.stat(os.path.join(folder, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(entries))  # least recently used first
+        self.current_bytes = sum(self.entries.values())
+
+    # Cache file of a thumbnail: a changed source (new mtime) gets a new file
+    def file_for(self, path, size=THUMBNAIL_SIZE):
+        path = os.path.abspath(path)
+        key = f"{path}|{size[0]}x{size[1]}|{os.stat(path).st_mtime_ns}"
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+
+    # Cached thumbnail file of `path`, or None when it has not been made yet
+    def get(self, path, size=THUMBNAIL_SIZE):
+        thumbnail = self.file_for(path, size)
+        name = os.path.basename(thumbnail)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        try:
+            os.utime(thumbnail)
+        except OSError:
+            # Removed behind our back (e.g. by another instance evicting it)
+            with self.lock:
+                self.current_bytes -= self.entries.pop(name, 0)
+            return None
+        return thumbnail
+
+    # Decode `path` at reduced scale (JPEG draft mode, see image_cache.py) and store its thumbnail
+    def make(self, path, size=THUMBNAIL_SIZE):
+        thumbnail = self.file_for(path, size)
+        img = load_preview(path, fit_size(_image_size(path), size))
+        img.thumbnail(size)
+        # Written under a temporary name so a half-written file is never taken for a thumbnail
+        temporary = f"{thumbnail}.{threading.get_ident()}.tmp"
+        img.save(temporary, "JPEG", quality=85)
+        os.replace(temporary, thumbnail)
+        name = os.path.basename(thumbnail)
+        with self.lock:
+            self.current_bytes -= self.entries.pop(name, 0)
+            self.entries[name] = os.path.getsize(thumbnail)
+            self.current_bytes += self.entries[name]
+            evicted = []
+            while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+                stale, stale_bytes = self.entries.popitem(last=False)
+                self.current_bytes -= stale_bytes
+                evicted.append(stale)
+        for stale in evicted:
+            try:
+                os.remove(os.path.join(self.folder, stale))
+            except OSError:
+                pass
+        return thumbnail
+
+    def clear(self):
+        with self.lock:
+            names = list(self.entries)
+            self.entries.clear()
+            self.current_bytes = 0
+        for name in names:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+
+
+def _image_size(path):
+    with Image.open(path) as img:
+        return img.size
+
+
+class ThumbnailLoader:
+    # Makes missing thumbnails on a few daemon threads. Requests are served in the order they were
+    # made, except that prioritize() moves the given paths (e.g. the visible ones) to the front.
+    def __init__(self, cache, workers=THUMBNAIL_WORKERS, size=THUMBNAIL_SIZE):
+        self.cache = cache
+        self.size = size
+        self.queue = []  # heap of (priority, path)
+        self.pending = {}  # path -> callbacks waiting for its thumbnail
+        self.making = set()  # paths a worker is making right now
+        self.order = itertools.count()
+        self.urgent = itertools.count(-1, -1)
+        self.condition = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self.run, name=f"thumbnails-{i}", daemon=True).start()
+
+    # Cached thumbnail file of `path` right away, or None after queueing it; callback(path, file or None)
+    # is then called from a worker thread once it is made (None if the image could not be read)
+    def request(self, path, callback):
+        try:
+            thumbnail = self.cache.get(path, self.size)
+        except OSError:
+            return None
+        if thumbnail is not None:
+            return thumbnail
+        with self.condition:
+            if path not in self.pending:
+                self.pending[path] = []
+                heapq.heappush(self.queue, (next(self.order), path))
+                self.condition.notify()
+            self.pending[path].append(callback)
+        return None
+
+    # Serve these paths before every other request still queued; older queue entries of the same
+    # paths are skipped when they come up
+    def prioritize(self, paths):
+        with self.condition:
+            for path in reversed(list(paths)):
+                if path in self.pending:
+                    heapq.heappush(self.queue, (next(self.urgent), path))
+            self.condition.notify_all()
+
+    # Drop every queued request (e.g. when the chooser moves to another folder)
+    def clear_pending(self):
+        with self.condition:
+            self.queue.clear()
+            self.pending.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    while not self.queue:
+                        self.condition.wait()
+                    _, path = heapq.heappop(self.queue)
+                    # Already made, being made or dropped: a stale entry left behind by prioritize()
+                    if path in self.pending and path not in self.making:
+                        break
+                callbacks = self.pending[path]
+                self.making.add(path)
+            try:
+                thumbnail = self.cache.make(path, self.size)
+            except Exception as e:
+                print(f"Could not make a thumbnail of {path}: {e}")
+                thumbnail = None
+            with self.condition:
+                self.making.discard(path)
+                # clear_pending() may have dropped the request, or a new one may have replaced it
+                if self.pending.get(path) is callbacks:
+                    del self.pending[path]
+            for callback in callbacks:
+                callback(path, thumbnail)
@@ -0,0 +1,79 @@
+# bench_change_color.py
+# Compares the per-pixel change_color loop with the array engine at 1, 12 and 48 MP
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ColorShift_Kivy"))
+import kernels
+
+
+# The original pure-Python implementation, kept as the reference output
+def legacy_change_color(img, target_color, color_to_change):
+    data = img.getdata()
+    new_image_data = []
+    for item in data:
+        r, g, b = item
+        color_map = {'r': r, 'g': g, 'b': b}
+        if color_map[color_to_change] >= color_map['r'] and color_map[color_to_change] >= color_map['g'] and color_map[color_to_change] >= color_map['b']:
+            factor = color_map[color_to_change] / 255.0
+            new_r = int((1 - factor) * r + factor * target_color[0])
+            new_g = int((1 - factor) * g + factor * target_color[1])
+            new_b = int((1 - factor) * b + factor * target_color[2])
+            new_image_data.append((new_r, new_g, new_b))
+        else:
+            new_image_data.append(item)
+    out = img.copy()
+    out.putdata(new_image_data)
+    return out
+
+
+def array_change_color(img, target_color, color_to_change):
+    rgb, alpha = kernels.to_array(img)
+    kernels.change_color(rgb, target_color, color_to_change)
+    return kernels.from_array(rgb, alpha)
+
+
+# Random noise keeps every branch of the dominant-channel test busy
+def synthetic_image(megapixels, seed=0):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1_000_000 / width)
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark change_color: per-pixel loop vs array engine.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 12, 48], help="image sizes in megapixels")
+    parser.add_argument("--legacy-max-mp", type=float, default=48, help="skip the slow legacy loop above this size")
+    parser.add_argument("--target", type=int, nargs=3, default=(102, 147, 163))
+    parser.add_argument("--channel", choices=("r", "g", "b"), default="r")
+    args = parser.parse_args()
+
+    target = tuple(args.target)
+    print(f"{'MP':>6} {'legacy (s)':>12} {'array (s)':>10} {'speedup':>9}  identical")
+    for megapixels in args.sizes:
+        img = synthetic_image(megapixels)
+        fast, fast_time = timed(array_change_color, img, target, args.channel)
+        if megapixels <= args.legacy_max_mp:
+            slow, slow_time = timed(legacy_change_color, img, target, args.channel)
+            identical = slow.tobytes() == fast.tobytes()
+            print(f"{megapixels:>6g} {slow_time:>12.2f} {fast_time:>10.3f} {slow_time / fast_time:>8.1f}x  {identical}")
+            if not identical:
+                sys.exit(f"Output mismatch at {megapixels} MP")
+        else:
+            print(f"{megapixels:>6g} {'skipped':>12} {fast_time:>10.3f} {'-':>9}  -")
+
+
+if __name__ == "__main__":
+    main()
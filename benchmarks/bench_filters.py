@@ -0,0 +1,65 @@
+# bench_filters.py
+# Times the variable-radius filters at radius 1, 10 and 100: their cost per pixel should stay flat as
+# the radius grows. Compares the tiled engine (filters.py) with one whole-image Pillow call and
+# checks that both give the same pixels.
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ColorShift_Kivy"))
+import filters
+
+
+# Smooth gradients plus noise, so blurs and sharpening both change the pixels
+def synthetic_image(megapixels, seed=0):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1_000_000 / width)
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 200, width, dtype=np.float32)[None, :, None]
+    noise = rng.integers(0, 56, (height, width, 3), dtype=np.uint8)
+    return (ramp + noise).astype(np.uint8)
+
+
+def timed(func, *args, repeat=1):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def whole_image(rgb, name, params):
+    return np.asarray(Image.fromarray(rgb).filter(filters.make_filter(name, params)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Gaussian blur, box blur and unsharp mask at growing radii.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[12], help="image sizes in megapixels")
+    parser.add_argument("--radii", type=float, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--operations", nargs="+", choices=filters.OPERATIONS, default=list(filters.OPERATIONS))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per measurement (the fastest is kept)")
+    args = parser.parse_args()
+
+    print(f"{'operation':<22} {'MP':>5} {'radius':>7} {'halo':>5} {'tiled (s)':>10} {'MP/s':>7} {'whole (s)':>10}  identical")
+    for megapixels in args.sizes:
+        rgb = synthetic_image(megapixels)
+        for name in args.operations:
+            for radius in args.radii:
+                params = filters.normalize(name, (radius,))
+                tiled, tiled_time = timed(filters.apply, rgb, name, params, repeat=args.repeat)
+                whole, whole_time = timed(whole_image, rgb, name, params, repeat=args.repeat)
+                identical = np.array_equal(tiled, whole)
+                print(f"{name:<22} {megapixels:>5g} {radius:>7g} {filters.halo(name, params):>5} {tiled_time:>10.3f} "
+                      f"{megapixels / tiled_time:>7.1f} {whole_time:>10.3f}  {identical}")
+                if not identical:
+                    sys.exit(f"Output mismatch for {name} at radius {radius}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# bench_operations.py
+# Times every ColorShift operation on synthetic images of several sizes and modes, records wall time,
+# megapixels per second and peak memory, and compares them with a saved baseline
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ColorShift_Kivy"))
+from color_shift import ColorShift
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Method name -> arguments it is benchmarked with
+OPERATIONS = {
+    "convert_to_black_and_white": (),
+    "change_black_background": ((255, 120, 0),),
+    "replace_border_background": ((255, 120, 0),),
+    "change_color": ((102, 147, 163), "r"),
+    "apply_color_mask": ((0, 128, 255),),
+    "apply_color_preset": ("sepia",),
+    "apply_gradient": ((255, 0, 0), (0, 0, 255)),
+    "apply_sharpen_blur": ("sharpen",),
+    "apply_gaussian_blur": (10,),
+    "apply_unsharp_mask": (2,),
+    "adjust_contrast_brightness": (1.3, 0.9),
+    "apply_transparency": (128,),
+}
+
+MODES = ("RGB", "RGBA", "L")
+
+
+# Random noise in the given mode, 4:3 aspect ratio
+def synthetic_image(megapixels, mode="RGB", seed=0):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1_000_000 / width)
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (height, width, bands), dtype=np.uint8)
+    return Image.fromarray(pixels[..., 0] if bands == 1 else pixels, mode)
+
+
+# Resident memory in bytes from /proc (Linux); the peak can be reset per measurement there
+def _proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def reset_peak_memory():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_memory():
+    try:
+        return _proc_status("VmRSS:")
+    except OSError:
+        return 0
+
+
+def peak_memory():
+    try:
+        return _proc_status("VmHWM:")
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS, and cannot be reset
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+# Run one operation `repeat` times on a fresh copy of the image; runs in its own process so the
+# peak memory of one measurement never leaks into the next. Best-of-repeat time; caches that an
+# operation keeps across images (e.g. gradient layers) are warm after the first run, as in a batch.
+def measure(operation, mode, megapixels, repeat):
+    img = synthetic_image(megapixels, mode)
+    pixels = img.width * img.height
+    shift = ColorShift.__new__(ColorShift)
+    shift.image_path = None
+    times = []
+    peak = None
+    for run in range(repeat):
+        shift.img = shift.shared_img = shift.source_img = img
+        gc.collect()
+        resettable = reset_peak_memory()
+        before = current_memory() if resettable else peak_memory()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            getattr(shift, operation)(*OPERATIONS[operation])
+        times.append(time.perf_counter() - start)
+        if peak is None:
+            peak = max(0, peak_memory() - before)
+        shift.img = None
+    seconds = min(times)
+    return {"seconds": seconds, "mpix_per_s": pixels / 1e6 / seconds, "peak_mb": peak / 2 ** 20, "size": [img.width, img.height]}
+
+
+def result_key(operation, mode, megapixels):
+    return f"{operation}/{mode}/{megapixels:g}MP"
+
+
+# Regressions of `current` against `baseline`: slower by more than `threshold`, or using more
+# than `threshold` more peak memory (differences below the time and memory floors are noise)
+def compare(current, baseline, threshold, time_floor=0.002, memory_floor_mb=16):
+    regressions = []
+    for key, result in current.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if result["seconds"] - reference["seconds"] > max(time_floor, reference["seconds"] * threshold):
+            regressions.append(f"{key}: {reference['seconds']:.4f}s -> {result['seconds']:.4f}s")
+        if result["peak_mb"] - reference["peak_mb"] > max(memory_floor_mb, reference["peak_mb"] * threshold):
+            regressions.append(f"{key}: peak {reference['peak_mb']:.0f} MB -> {result['peak_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every ColorShift operation and check for regressions.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 12], help="image sizes in megapixels")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--operations", nargs="+", choices=list(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (the fastest is kept)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown / memory growth as a fraction (default 0.25)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'operation':<28} {'mode':<5} {'MP':>5} {'time (s)':>10} {'MP/s':>9} {'peak MB':>9}")
+    # One process per measurement (see measure)
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for megapixels in args.sizes:
+            for mode in args.modes:
+                for operation in args.operations:
+                    result = pool.apply(measure, (operation, mode, megapixels, args.repeat))
+                    results[result_key(operation, mode, megapixels)] = result
+                    print(f"{operation:<28} {mode:<5} {megapixels:>5g} {result['seconds']:>10.4f} {result['mpix_per_s']:>9.1f} {result['peak_mb']:>9.1f}")
+
+    report = {"machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) past {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"No regressions past {args.threshold:.0%} against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
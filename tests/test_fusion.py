@@ -0,0 +1,40 @@
+# test_fusion.py
+# Fused affine runs (see presets.fuse_linear) must give the pixels of applying each step on its own,
+# which clamps to 0-255 after every step, up to the rounding of the combined matrix
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ColorShift_Kivy"))
+from color_shift import ColorShift
+from pipeline import Pipeline
+
+# Chains whose intermediate results saturate (and one that stays in range, so it is fused)
+CHAINS = [
+    [("apply_color_preset", "vintage"), ("adjust_contrast_brightness", 1.0, 0.5)],
+    [("adjust_contrast_brightness", 2.0, 0.5)],
+    [("apply_color_preset", "warm"), ("apply_color_preset", "warm"), ("adjust_contrast_brightness", 1.0, 1.5)],
+    [("apply_color_preset", "sepia"), ("apply_color_preset", "cool")],
+    [("adjust_contrast_brightness", 0.5, 0.8), ("apply_color_preset", "cool")],
+]
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / "noise.png")
+    Image.fromarray(np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(path)
+    return path
+
+
+@pytest.mark.parametrize("steps", CHAINS)
+def test_fused_chain_matches_sequential_methods(image_path, steps):
+    sequential = ColorShift(image_path)
+    for name, *params in steps:
+        getattr(sequential, name)(*params)
+    with Image.open(image_path) as source:
+        fused = Pipeline(steps).run(source.convert("RGB"))
+    difference = np.abs(np.asarray(sequential.img.convert("RGB"), dtype=int) - np.asarray(fused, dtype=int))
+    assert difference.max() <= 2
@@ -0,0 +1,23 @@
+# test_prefix_cache.py
+# A chain rendered from a cached prefix must give the pixels of rendering it from scratch
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ColorShift_Kivy"))
+from pipeline import Pipeline
+from prefix_cache import PrefixCache
+
+
+def test_shared_prefix_matches_cold_render():
+    img = Image.fromarray(np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8))
+    # The first chain caches the brightness step alone; in the second one it is fused with the next
+    # brightness step, so the cached prefix must not be used
+    first = [("adjust_contrast_brightness", 1.0, 0.8), ("apply_transparency", 90)]
+    second = [("adjust_contrast_brightness", 1.0, 0.8), ("adjust_contrast_brightness", 1.0, 0.7)]
+    cache = PrefixCache()
+    cache.render("source", img, first)
+    warm = cache.render("source", img, second)
+    assert np.array_equal(np.asarray(warm), np.asarray(Pipeline(second).run(img)))